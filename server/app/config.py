@@ -0,0 +1,87 @@
+"""
+Configuration of the application.
+
+All values are read from environment variables, so that the same code can be
+started locally and in production without any changes:
+
+    WS_PROFILE      - runtime profile: "default" or "production"
+    WS_HOST         - host to listen on
+    WS_PORT         - port to listen on
+    WS_WORKERS      - number of worker processes (production profile only, echo router only)
+    WS_BACKLOG      - size of the listen queue of the socket
+    WS_REUSE_PORT   - "1" to let every worker listen on its own SO_REUSEPORT socket
+    WS_ROUTERS      - comma separated routers to enable: echo,broadcast,chat,hh,admin
+    WS_DRAIN_TIMEOUT - seconds active sessions get to finish when draining
+    WS_DRAIN_FILE   - file the waiting queue is exported to when draining, and
+                      imported from on startup
+    WS_RESUME_TTL   - seconds an imported place in the queue is kept for the user
+    WS_STATE_DIR    - directory to persist the waiting queue and chat state to.
+                      Persistence is disabled if not set
+    WS_FSYNC_INTERVAL - seconds state changes are collected before one fsync
+    WS_SNAPSHOT_INTERVAL - seconds between compacted snapshots of the state
+    WS_TRANSCRIPT_DIR - directory for conversation transcripts. Disabled if not set
+    WS_TRANSCRIPT_FLUSH_INTERVAL - seconds transcripts are buffered before written
+    WS_TRANSCRIPT_SEGMENT_BYTES - size of a transcript segment before rotation
+    WS_TRANSCRIPT_MAX_BUFFERED - buffered messages after which new ones are dropped
+    WS_QUEUE_STATUS_INTERVAL - seconds between queue position pushes. 0 disables them
+    WS_DEFAULT_TENANT - tenant of the connections that did not specify one
+    WS_TENANT_TOKENS - JSON object token -> list of tenant ids
+    WS_TENANT_WEIGHTS - JSON object tenant id -> weight when agents pick the next user
+    WS_PROFILER     - "1" to measure event loop lag and record slow callbacks
+    WS_PROFILER_INTERVAL_MS - how often the event loop lag is measured
+    WS_PROFILER_THRESHOLD_MS - lag after which a callback is recorded as slow
+"""
+import json
+import os
+
+from typing import List
+
+
+def _get_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+def _get_json(name: str, default):
+    value = os.getenv(name)
+    if not value:
+        return default
+    return json.loads(value)
+
+def _get_list(name: str, default: str) -> List[str]:
+    return [item.strip() for item in os.getenv(name, default).split(",") if item.strip()]
+
+
+class Settings():
+    def __init__(self) -> None:
+        self.profile = os.getenv("WS_PROFILE", "default")
+        self.host = os.getenv("WS_HOST", "127.0.0.1")
+        self.port = int(os.getenv("WS_PORT", "8080"))
+        self.workers = int(os.getenv("WS_WORKERS", "1"))
+        self.backlog = int(os.getenv("WS_BACKLOG", "4096"))
+        self.reuse_port = _get_bool("WS_REUSE_PORT", True)
+        self.routers = _get_list("WS_ROUTERS", "echo,broadcast,chat,hh")
+        self.drain_timeout = float(os.getenv("WS_DRAIN_TIMEOUT", "30"))
+        self.drain_file = os.getenv("WS_DRAIN_FILE") or None
+        self.resume_ttl = float(os.getenv("WS_RESUME_TTL", "60"))
+        self.state_dir = os.getenv("WS_STATE_DIR") or None
+        self.fsync_interval = float(os.getenv("WS_FSYNC_INTERVAL", "0.05"))
+        self.snapshot_interval = float(os.getenv("WS_SNAPSHOT_INTERVAL", "60"))
+        self.transcript_dir = os.getenv("WS_TRANSCRIPT_DIR") or None
+        self.transcript_flush_interval = float(os.getenv("WS_TRANSCRIPT_FLUSH_INTERVAL", "1"))
+        self.transcript_segment_bytes = int(os.getenv("WS_TRANSCRIPT_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+        self.transcript_max_buffered = int(os.getenv("WS_TRANSCRIPT_MAX_BUFFERED", "100000"))
+        self.queue_status_interval = float(os.getenv("WS_QUEUE_STATUS_INTERVAL", "5"))
+        self.default_tenant = os.getenv("WS_DEFAULT_TENANT", "tenant_123")
+        self.tenant_tokens = _get_json("WS_TENANT_TOKENS", {})
+        self.tenant_weights = _get_json("WS_TENANT_WEIGHTS", {})
+        self.profiler = _get_bool("WS_PROFILER", False)
+        self.profiler_interval = float(os.getenv("WS_PROFILER_INTERVAL_MS", "100")) / 1000
+        self.profiler_threshold = float(os.getenv("WS_PROFILER_THRESHOLD_MS", "50")) / 1000
+
+    def __repr__(self):
+        return f"<Settings profile={self.profile} host={self.host} port={self.port}>"
+
+
+settings = Settings()
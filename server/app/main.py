@@ -1,27 +1,141 @@
 """
 Main FastAPI application module.
+
+The app is built by create_app(), which only imports the routers that are
+enabled in the configuration (WS_ROUTERS). Time spent importing FastAPI and
+every router is recorded and printed on startup, to keep an eye on how fast a
+new worker is ready to accept connections. Every router has its own module, so
+the time of a router is what enabling it adds (modules shared by several
+routers count towards the first one that imports them).
 """
-import uvicorn
+import asyncio
+import importlib
+import json
+import os
+import time
+
+_import_started = time.perf_counter()
 
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from routers.websocket import websocket_router
-from routers.human_handover import ws_hh_router
+from typing import Dict
 
+_fastapi_import_time = time.perf_counter() - _import_started
+
+from config import Settings, settings
 from utils.connection_pool import WaitingPool
+from utils.persistence import StoreState, state_store
+from utils.profiler import loop_profiler
+from utils.queue_status import queue_status
+from utils.transcripts import transcript_recorder
+
+# Router name -> (module, router attribute, prefix)
+ROUTERS = {
+    "echo": ("routers.echo", "echo_router", ""),
+    "broadcast": ("routers.broadcast", "broadcast_router", ""),
+    "chat": ("routers.chat", "chat_router", ""),
+    "hh": ("routers.human_handover", "ws_hh_router", "/hh"),
+    "admin": ("routers.admin", "admin_router", "/admin"),
+}
 
-app = FastAPI(
-    title='Test Websocket',
-    description='Test Websocket Endpoint - Simple echo server',
-)
 
-@app.on_event("startup")
-async def startup():
+@asynccontextmanager
+async def lifespan(app: FastAPI):
     # Initialize the connection list on startup
-    app.state.connections = WaitingPool() # WS connections
+    app.state.connections = WaitingPool(store=state_store) # WS connections
+    app.state.recovered_chat_requests = {}
+    _import_drained_queue(app.state.connections, settings)
+    _recover_state(app, settings)
+    if settings.transcript_dir:
+        transcript_recorder.start(settings.transcript_dir, settings.transcript_flush_interval,
+                                  settings.transcript_segment_bytes, settings.transcript_max_buffered)
+    if "hh" in settings.routers:
+        queue_status.start(app, settings.queue_status_interval)
+    if settings.profiler:
+        loop_profiler.start(settings.profiler_interval, settings.profiler_threshold)
+
+    app.state.import_times["ready"] = time.perf_counter() - _import_started
+    print("Import times: " + ", ".join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in app.state.import_times.items()))
+    yield
+    loop_profiler.stop()
+    queue_status.stop()
+    await transcript_recorder.stop()
+    state_store.close()
+
+def _import_drained_queue(pool: WaitingPool, settings: Settings):
+    """
+    Takes over the waiting queue of the previous (drained) server.
+    The file is claimed by renaming it first, so only one of several
+    successors starting at the same time imports it.
+    """
+    if not settings.drain_file:
+        return
+    claimed_file = f"{settings.drain_file}.{os.getpid()}"
+    try:
+        os.rename(settings.drain_file, claimed_file)
+    except FileNotFoundError:
+        return # Nothing was drained, or another process already imported it
+    with open(claimed_file) as f:
+        queue = json.load(f)
+    os.remove(claimed_file)
+    imported = pool.import_reservations(queue, settings.resume_ttl)
+    print(f"Imported {imported} waiting connections from {settings.drain_file}")
+
+def _recover_state(app: FastAPI, settings: Settings):
+    """
+    Rebuilds the waiting queue and pending chat requests from the state
+    persisted before a crash, and starts persisting the state again.
+    """
+    if not settings.state_dir:
+        return
+    recovered = state_store.load(settings.state_dir)
+    imported = app.state.connections.import_reservations(recovered.waiting_queues(), settings.resume_ttl)
+    app.state.recovered_chat_requests = recovered.chat_requests
+    print(f"Recovered {imported} waiting connections and {len(recovered.chat_requests)} chat states")
+
+    # Places and chat requests that were not claimed in time are forgotten
+    asyncio.get_running_loop().call_later(settings.resume_ttl, _expire_recovered_chat_requests, app)
+
+    state = StoreState.from_dict({
+        "seq": recovered.seq,
+        "pool": app.state.connections.export(),
+        "chat_requests": recovered.chat_requests,
+    })
+    state_store.start(settings.state_dir, state, settings.fsync_interval, settings.snapshot_interval)
+
+def _expire_recovered_chat_requests(app: FastAPI):
+    for user_id in app.state.recovered_chat_requests:
+        state_store.record("chat_user_remove", user_id)
+    app.state.recovered_chat_requests = {}
+
+def create_app(settings: Settings) -> FastAPI:
+    """
+    Application factory. Includes only the routers enabled in the settings.
+    """
+    app = FastAPI(
+        title='Test Websocket',
+        description='Test Websocket Endpoint - Simple echo server',
+        lifespan=lifespan,
+    )
+    import_times: Dict[str, float] = {"fastapi": _fastapi_import_time}
+
+    # Adding the endpoinds
+    for name in settings.routers:
+        if name not in ROUTERS:
+            raise ValueError(f"Unknown router {name}. Expected one of {list(ROUTERS)}")
+        module_name, router_name, prefix = ROUTERS[name]
+
+        started = time.perf_counter()
+        module = importlib.import_module(module_name)
+        import_times[name] = time.perf_counter() - started
+
+        app.include_router(getattr(module, router_name), prefix=prefix)
+
+    app.state.import_times = import_times
+    return app
 
-# Adding the endpoinds
-app.include_router(websocket_router)
-app.include_router(ws_hh_router, prefix='/hh')
+app = create_app(settings)
 
 if __name__ == "__main__":
-    uvicorn.run(app, port=8080, log_level="info")
\ No newline at end of file
+    from utils.runtime import run # uvicorn is not needed when imported by a worker
+    run(app, settings)
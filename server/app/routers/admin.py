@@ -0,0 +1,71 @@
+"""
+Admin endpoints.
+
+Should only be reachable from the internal network - there is no
+authentication. Not enabled by default, add "admin" to WS_ROUTERS.
+"""
+from fastapi import APIRouter, Request
+from typing import Dict, List
+
+from config import settings
+from utils.drain import drain_manager
+from utils.persistence import state_store
+from utils.profiler import loop_profiler
+from utils.transcripts import transcript_recorder
+
+admin_router = APIRouter()
+
+
+@admin_router.post("/drain")
+async def start_drain(request: Request, timeout: float = settings.drain_timeout):
+    """
+    Start draining the server before a restart. Check the progress with
+    GET /admin/drain, the exported queue is returned when it is done.
+    """
+    drain_manager.start(request.app, timeout, settings.drain_file)
+    return drain_manager.status()
+
+@admin_router.get("/drain")
+async def get_drain_status():
+    return drain_manager.status()
+
+@admin_router.post("/queue")
+async def import_queue(request: Request, queue: Dict[str, List[str]]):
+    """
+    Import the waiting queue exported by a drained server
+    """
+    imported = request.app.state.connections.import_reservations(queue, settings.resume_ttl)
+    return {"imported": imported}
+
+@admin_router.get("/transcripts")
+async def get_transcript_metrics():
+    """
+    Backpressure metrics of the transcript writer
+    """
+    return transcript_recorder.metrics()
+
+@admin_router.get("/state")
+async def get_state_store_metrics():
+    """
+    Write errors and records not written yet of the state store (WS_STATE_DIR)
+    """
+    return state_store.metrics()
+
+@admin_router.get("/profiler")
+async def get_profiler_stats():
+    """
+    Event loop lag and the slow callbacks, attributed to router functions.
+    Enable with WS_PROFILER=1 or POST /admin/profiler.
+    """
+    return loop_profiler.stats()
+
+@admin_router.post("/profiler")
+async def start_profiler():
+    if not loop_profiler.enabled:
+        loop_profiler.start(settings.profiler_interval, settings.profiler_threshold)
+    return loop_profiler.stats()
+
+@admin_router.delete("/profiler")
+async def reset_profiler():
+    loop_profiler.reset()
+    return loop_profiler.stats()
@@ -0,0 +1,102 @@
+"""
+/broadcast router.
+
+/broadcast retranslates the message to all connections of the tenant that are
+subscribed to the same topic (see /echo for replying to the same connection
+only).
+
+/broadcast understands the following JSON messages:
+    {"type": "subscribe", "topic": "<topic>"}
+    {"type": "unsubscribe", "topic": "<topic>"}
+    {"type": "publish", "topic": "<topic>", "content": "<message>"}
+Any other message is published to the default topic of the tenant, which every
+connection is subscribed to on connect.
+"""
+import json
+
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+
+from utils.batching import enable_batching, send_text, discard
+from utils.connections import ConnectionManager, DEFAULT_TOPIC
+from utils.drain import drain_manager
+from utils import tenants
+from utils.tenants import resolve_tenant_id
+
+broadcast_router = APIRouter()
+manager = ConnectionManager()
+
+# Endpoinds
+@broadcast_router.websocket("/broadcast")
+async def broadcast_endpoint(websocket: WebSocket, batch_ms: int = 0):
+    if drain_manager.draining:
+        await drain_manager.reject(websocket)
+        return
+
+    tenant_id = resolve_tenant_id(websocket)
+    if tenant_id is None:
+        await tenants.reject(websocket)
+        return
+
+    await manager.connect(websocket, tenant_id)
+    enable_batching(websocket, batch_ms)
+    drain_manager.register(websocket)
+    
+    try:
+        while True:
+            # Receive message from client
+            data = await websocket.receive_text()
+            await handle_broadcast_message(websocket, data)
+            
+    except WebSocketDisconnect:
+        discard(websocket)
+        drain_manager.unregister(websocket)
+        manager.disconnect(websocket)
+    except Exception as e:
+        print(f"Error in websocket connection: {e}")
+        discard(websocket)
+        drain_manager.unregister(websocket)
+        manager.disconnect(websocket)
+
+async def handle_broadcast_message(websocket: WebSocket, data: str):
+    """Handle subscribe/unsubscribe/publish messages sent to /broadcast"""
+    try:
+        message_data = json.loads(data)
+    except json.JSONDecodeError:
+        message_data = None
+
+    if not isinstance(message_data, dict) or "topic" not in message_data:
+        # Plain message - broadcast it to the default topic of the tenant
+        await manager.publish(websocket.tenant_id, DEFAULT_TOPIC, f"Broadcast: {data}")
+        return
+
+    message_type = message_data.get("type")
+    topic = str(message_data["topic"])
+
+    if message_type == "subscribe":
+        manager.subscribe(websocket, topic)
+        await send_text(websocket, json.dumps({
+            "type": "subscribed",
+            "topic": topic
+        }))
+    elif message_type == "unsubscribe":
+        if manager.unsubscribe(websocket, topic):
+            await send_text(websocket, json.dumps({
+                "type": "unsubscribed",
+                "topic": topic
+            }))
+        else:
+            await send_text(websocket, json.dumps({
+                "type": "error",
+                "message": f"Not subscribed to {topic}"
+            }))
+    elif message_type == "publish":
+        await manager.publish(websocket.tenant_id, topic, json.dumps({
+            "type": "message",
+            "topic": topic,
+            "content": message_data.get("content", "")
+        }))
+    else:
+        await send_text(websocket, json.dumps({
+            "type": "error",
+            "message": f"Unknown message type {message_type}"
+        }))
@@ -1,12 +1,9 @@
 """
-Main place for routers.
+/chat router.
 
-Contains the websocket endpoinds only
-
-Note:
-/broadcast and /echo are functionally very similar. The difference is that the
-/echo will only reply with the message to the same connection, whilst /broadcast
-will retranslate the message to all connections.
+Users chat with each other: either with a user of the given id, or with the
+first available user (/chat/none). The receiver gets a chat request it can
+accept or decline.
 """
 import uuid
 import json
@@ -14,62 +11,41 @@ import json
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 from typing import Dict
 
-from utils.connections import ConnectionManager
+from utils.batching import enable_batching, send_text, discard
+from utils.drain import drain_manager
+from utils.persistence import state_store
 
-websocket_router = APIRouter()
-manager = ConnectionManager()
+chat_router = APIRouter()
 connected_users: Dict[str, WebSocket] = {}
 user_chat_states: Dict[str, Dict] = {}  # user_id -> {"receiver_id": str, "pending_requests": list}
 
 # Endpoinds
-@websocket_router.websocket("/broadcast")
-async def broadcast_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
-    
-    try:
-        while True:
-            # Receive message from client
-            data = await websocket.receive_text()
-            
-            # Broadcast the message to all connected clients
-            broadcast_message = f"Broadcast: {data}"
-            await manager.broadcast(broadcast_message)
-            
-    except WebSocketDisconnect:
-        manager.disconnect(websocket)
-    except Exception as e:
-        print(f"Error in websocket connection: {e}")
-        manager.disconnect(websocket)
-
-@websocket_router.websocket("/echo")
-async def echo_endpoint(websocket: WebSocket):
-    await websocket.accept()
-
-    try:
-        while True:
-            data = await websocket.receive_text()
-            await websocket.send_text(data)
-
-    except WebSocketDisconnect:
-        print("Connection closed by client")
+@chat_router.websocket("/chat/{receiver_id}")
+async def chat_endpoint(websocket: WebSocket, receiver_id: str | None, batch_ms: int = 0, resume: str | None = None):
+    if drain_manager.draining:
+        await drain_manager.reject(websocket)
         return
 
-# Global storage for user connections and chat states
-
-@websocket_router.websocket("/chat/{receiver_id}")
-async def chat_endpoint(websocket: WebSocket, receiver_id: str | None):
-    # Generate unique user ID
-    user_id = str(uuid.uuid4())[:8]
+    # Generate unique user ID, or take the one the user had before the restart
+    recovered_requests = websocket.app.state.recovered_chat_requests
+    if resume in recovered_requests and resume not in connected_users:
+        user_id = resume
+        pending_requests = recovered_requests.pop(resume)
+    else:
+        user_id = str(uuid.uuid4())[:8]
+        pending_requests = []
     
     try:
         # 1. Establish connection with the new user
         await websocket.accept()
+        enable_batching(websocket, batch_ms)
+        drain_manager.register(websocket)
         connected_users[user_id] = websocket
         
         # 2. Get their websocket data to be stored into a hash-map
         user_chat_states[user_id] = {
             "receiver_id": None,
-            "pending_requests": [],
+            "pending_requests": pending_requests,
             "chat_active": False
         }
         
@@ -82,7 +58,7 @@ async def chat_endpoint(websocket: WebSocket, receiver_id: str | None):
             if receiver_id in connected_users:
                 await handle_chat_request(websocket, user_id, receiver_id)
             else:
-                await websocket.send_text(json.dumps({
+                await send_text(websocket, json.dumps({
                     "type": "error",
                     "message": f"User {receiver_id} is not online"
                 }))
@@ -107,7 +83,7 @@ async def chat_endpoint(websocket: WebSocket, receiver_id: str | None):
 async def handle_no_receiver(websocket: WebSocket, user_id: str):
     """Handle user who wants to chat with any available user"""
     # Send welcome message with user ID
-    await websocket.send_text(json.dumps({
+    await send_text(websocket, json.dumps({
         "type": "welcome",
         "message": f"Welcome! Your ID is {user_id}. Looking for available users...",
         "user_id": user_id
@@ -123,7 +99,7 @@ async def handle_no_receiver(websocket: WebSocket, user_id: str):
     if available_user:
         await handle_chat_request(websocket, user_id, available_user)
     else:
-        await websocket.send_text(json.dumps({
+        await send_text(websocket, json.dumps({
             "type": "info",
             "message": "No available users right now. Your messages will be queued until someone connects."
         }))
@@ -133,14 +109,14 @@ async def handle_chat_request(websocket: WebSocket, sender_id: str, receiver_id:
     receiver_websocket = connected_users.get(receiver_id)
     
     if not receiver_websocket:
-        await websocket.send_text(json.dumps({
+        await send_text(websocket, json.dumps({
             "type": "error",
             "message": f"User {receiver_id} is not available"
         }))
         return
     
     # Send chat request to receiver
-    await receiver_websocket.send_text(json.dumps({
+    await send_text(receiver_websocket, json.dumps({
         "type": "chat_request",
         "message": f"User {sender_id} wants to start a chat with you. Reply 'accept' or 'decline'",
         "sender_id": sender_id
@@ -148,9 +124,10 @@ async def handle_chat_request(websocket: WebSocket, sender_id: str, receiver_id:
     
     # Add to pending requests
     user_chat_states[receiver_id]["pending_requests"].append(sender_id)
+    state_store.record("chat_request", receiver_id, sender_id)
     
     # Notify sender
-    await websocket.send_text(json.dumps({
+    await send_text(websocket, json.dumps({
         "type": "info",
         "message": f"Chat request sent to {receiver_id}. Waiting for response..."
     }))
@@ -165,27 +142,25 @@ async def handle_message(user_id: str, message_data: dict):
     
     if message_type == "accept":
         # Handle chat acceptance
-        if user_state["pending_requests"]:
-            sender_id = user_state["pending_requests"].pop(0)
+        sender_id = pop_pending_request(user_id)
+        if sender_id:
             await establish_chat(user_id, sender_id)
         else:
-            await websocket.send_text(json.dumps({
+            await send_text(websocket, json.dumps({
                 "type": "error",
                 "message": "No pending chat requests"
             }))
     
     elif message_type == "decline":
         # Handle chat decline
-        if user_state["pending_requests"]:
-            sender_id = user_state["pending_requests"].pop(0)
-            sender_websocket = connected_users.get(sender_id)
-            if sender_websocket:
-                await sender_websocket.send_text(json.dumps({
-                    "type": "info",
-                    "message": f"User {user_id} declined your chat request"
-                }))
+        sender_id = pop_pending_request(user_id)
+        if sender_id:
+            await send_text(connected_users[sender_id], json.dumps({
+                "type": "info",
+                "message": f"User {user_id} declined your chat request"
+            }))
         else:
-            await websocket.send_text(json.dumps({
+            await send_text(websocket, json.dumps({
                 "type": "error",
                 "message": "No pending chat requests"
             }))
@@ -196,23 +171,38 @@ async def handle_message(user_id: str, message_data: dict):
             # 5. Send the message to the receiver using the receiver_id and the hash_map
             receiver_websocket = connected_users.get(user_state["receiver_id"])
             if receiver_websocket:
-                await receiver_websocket.send_text(json.dumps({
+                await send_text(receiver_websocket, json.dumps({
                     "type": "message",
                     "sender_id": user_id,
                     "content": content
                 }))
             else:
-                await websocket.send_text(json.dumps({
+                await send_text(websocket, json.dumps({
                     "type": "error",
                     "message": "Receiver is no longer available"
                 }))
         else:
             # User not in active chat - queue message or inform them
-            await websocket.send_text(json.dumps({
+            await send_text(websocket, json.dumps({
                 "type": "info",
                 "message": "You're not in an active chat. Messages will be queued until you connect with someone."
             }))
 
+def pop_pending_request(user_id: str) -> str | None:
+    """
+    Takes the oldest pending chat request whose sender is still online.
+    Requests of senders that went offline (e.g. requests recovered after a
+    restart, whose senders never reconnected) are dropped on the way.
+    Returns None if no request is left.
+    """
+    pending_requests = user_chat_states[user_id]["pending_requests"]
+    while pending_requests:
+        sender_id = pending_requests.pop(0)
+        state_store.record("chat_request_pop", user_id)
+        if sender_id in connected_users:
+            return sender_id
+    return None
+
 async def establish_chat(user1_id: str, user2_id: str):
     """Establish active chat between two users"""
     # Set up chat state for both users
@@ -226,13 +216,13 @@ async def establish_chat(user1_id: str, user2_id: str):
     user1_websocket = connected_users[user1_id]
     user2_websocket = connected_users[user2_id]
     
-    await user1_websocket.send_text(json.dumps({
+    await send_text(user1_websocket, json.dumps({
         "type": "chat_started",
         "message": f"Chat started with {user2_id}. You can now send messages!",
         "partner_id": user2_id
     }))
     
-    await user2_websocket.send_text(json.dumps({
+    await send_text(user2_websocket, json.dumps({
         "type": "chat_started",
         "message": f"Chat started with {user1_id}. You can now send messages!",
         "partner_id": user1_id
@@ -247,7 +237,7 @@ async def handle_disconnect(user_id: str):
             partner_id = user_state["receiver_id"]
             partner_websocket = connected_users.get(partner_id)
             if partner_websocket:
-                await partner_websocket.send_text(json.dumps({
+                await send_text(partner_websocket, json.dumps({
                     "type": "info",
                     "message": f"User {user_id} has disconnected"
                 }))
@@ -256,14 +246,17 @@ async def handle_disconnect(user_id: str):
                 user_chat_states[partner_id]["chat_active"] = False
         
         # Clean up
+        discard(connected_users[user_id])
+        drain_manager.unregister(connected_users[user_id])
         del connected_users[user_id]
         if user_id in user_chat_states:
             del user_chat_states[user_id]
+            state_store.record("chat_user_remove", user_id)
         
         print(f"User {user_id} disconnected")
 
 # Helper endpoint to get connected users (for debugging)
-@websocket_router.get("/chat/users")
+@chat_router.get("/chat/users")
 async def get_connected_users():
     return {
         "connected_users": list(connected_users.keys()),
@@ -288,4 +281,4 @@ async def get_connected_users():
 #     # If yes - the receiver_id will be set
 #     # 4. Wait for the message
 #     # 5. Send the message to the receiver using the receiver_id and the hash_map
-#     pass
\ No newline at end of file
+#     pass
@@ -0,0 +1,31 @@
+"""
+/echo router.
+
+Replies with the message to the same connection only.
+"""
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+
+from utils.batching import send_text
+from utils.drain import drain_manager
+
+echo_router = APIRouter()
+
+# Endpoinds
+@echo_router.websocket("/echo")
+async def echo_endpoint(websocket: WebSocket):
+    if drain_manager.draining:
+        await drain_manager.reject(websocket)
+        return
+
+    await websocket.accept()
+    drain_manager.register(websocket)
+
+    try:
+        while True:
+            data = await websocket.receive_text()
+            await send_text(websocket, data)
+
+    except WebSocketDisconnect:
+        print("Connection closed by client")
+        drain_manager.unregister(websocket)
+        return
@@ -3,29 +3,54 @@ module that will try to simulate the human handover solution we are
 trying to intergrate into the Chat API
 """
 import asyncio
+import uuid
 
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, FastAPI
+from utils.batching import enable_batching, send_text, close, discard
+from utils.drain import drain_manager
 from utils.enums import ConnectionType, ChatMode
 from utils.human_handover.managers import ConnectionManager
-from typing import Optional
+from utils.queue_status import queue_status
+from utils import tenants
+from utils.tenants import resolve_tenant_ids
+from utils.transcripts import transcript_recorder
+from typing import List, Optional
 
 ws_hh_router = APIRouter() # WebSocket, Human Handover Router :)
 connection_manager = ConnectionManager() # Now just a wrapper for app.state
 
 @ws_hh_router.websocket("/user")
-async def user_endpoint(websocket: WebSocket):
+@ws_hh_router.websocket("/{tenant_id}/user")
+async def user_endpoint(websocket: WebSocket, batch_ms: int = 0, resume: Optional[str] = None):
     """
     This endpoint is the endpoint for the regular user.
 
     The endpoint will manage the state of the chat
     The endpoint will redirect messages to AI / human, depending on the state
     The endpoint will manage the websocket manager
+
+    `resume` is the conn_id the user got when the previous server was drained.
+    It is used to give the user back their place in the queue.
+
+    The tenant is taken from the path, query or token (see utils/tenants.py).
     """
+    if drain_manager.draining:
+        await drain_manager.reject(websocket)
+        return
+
+    tenant_ids = resolve_tenant_ids(websocket)
+    if tenant_ids is None:
+        await tenants.reject(websocket)
+        return
     
     await websocket.accept()
     
     # Initial setup
-    _add_user_websocket_attributes(websocket)
+    _add_user_websocket_attributes(websocket, tenant_ids[0])
+    enable_batching(websocket, batch_ms)
+    drain_manager.register(websocket)
+    if resume:
+        await _resume_waiting_position(websocket, resume, tenant_ids)
 
     try:
         while True:
@@ -41,6 +66,8 @@ async def user_endpoint(websocket: WebSocket):
             
     except WebSocketDisconnect:
         print("User closed connection")
+        discard(websocket)
+        drain_manager.unregister(websocket)
         if websocket.receipient_websocket:
             await _close_receipient_websocket_connection(websocket.receipient_websocket)
         await _user_disconnect_cleanup(websocket)
@@ -48,21 +75,41 @@ async def user_endpoint(websocket: WebSocket):
         print(f"Error in websocket connection: {e}")
 
 @ws_hh_router.websocket("/agent")
-async def agent_endpoint(websocket: WebSocket):
+@ws_hh_router.websocket("/{tenant_id}/agent")
+async def agent_endpoint(websocket: WebSocket, batch_ms: int = 0):
+    """
+    This endpoint is the endpoint for the agents.
+
+    Agents can serve several tenants: /hh/agent?tenant_ids=tenant_1,tenant_2
+    or through the token (see utils/tenants.py).
+    """
+    if drain_manager.draining:
+        await drain_manager.reject(websocket)
+        return
+
+    tenant_ids = resolve_tenant_ids(websocket)
+    if tenant_ids is None:
+        await tenants.reject(websocket)
+        return
+
     await websocket.accept()
     # Initial setup
-    _add_agent_websocket_attributes(websocket)
+    _add_agent_websocket_attributes(websocket, tenant_ids)
+    enable_batching(websocket, batch_ms)
+    drain_manager.register(websocket)
 
     try:
         # Connection establishing
-        await websocket.send_text("Looking for a connection...")
+        await send_text(websocket, "Looking for a connection...")
         app = websocket.app
         receipient_websocket = await _agent_establish_connection(websocket, app)
         if receipient_websocket:
-            await websocket.send_text("Connection found")
+            await send_text(websocket, "Connection found")
+        elif drain_manager.draining:
+            return # The connection was already closed by the drain
         else:
-            await websocket.send_text("Connection Search Timeout. Goodbye")
-            await websocket.close(code=1000, reason="Connection Search Timeout.")
+            await send_text(websocket, "Connection Search Timeout. Goodbye")
+            await close(websocket, code=1000, reason="Connection Search Timeout.")
         
         # Main loop
         while True:
@@ -71,9 +118,12 @@ async def agent_endpoint(websocket: WebSocket):
 
     except WebSocketDisconnect:
         print("Agent closed connection")
+        discard(websocket)
+        drain_manager.unregister(websocket)
         if websocket.receipient_websocket:
             await _notify_user_about_agent_disconnect(websocket.receipient_websocket)
-            await connection_manager.add_connection(websocket.receipient_websocket)
+            await connection_manager.end_session(websocket.receipient_websocket)
+            await _add_to_waiting_queue(websocket.receipient_websocket)
         await _agent_disconnect_cleanup(websocket)
     except Exception as e:
         print(f"Error in websocket connection: {e}")
@@ -95,7 +145,10 @@ async def _ai_conversation_handler(incomming_message:str, websocket: WebSocket):
         incomming_message (str) - the message received from user
         websocket (WebSocket) - websocket connection
     """
-    await websocket.send_text(incomming_message)
+    ai_response = incomming_message
+    transcript_recorder.record(websocket.session_id, ConnectionType.USER.value, incomming_message)
+    transcript_recorder.record(websocket.session_id, "AI", ai_response)
+    await send_text(websocket, ai_response)
 
 async def _agent_conversation_handler(incomming_message:str, sender: WebSocket):
     """
@@ -106,14 +159,18 @@ async def _agent_conversation_handler(incomming_message:str, sender: WebSocket):
     receipient = sender.receipient_websocket
     if receipient is None:
         # Relay message that the connection is not yet established
-        await sender.send_text(please_wait_msg)
+        if sender.connection_type is ConnectionType.USER:
+            please_wait_msg += _queue_status_text(sender)
+        await send_text(sender, please_wait_msg)
     else:
-        await receipient.send_text(incomming_message)
+        user = sender if sender.connection_type is ConnectionType.USER else receipient
+        transcript_recorder.record(user.session_id, sender.connection_type.value, incomming_message)
+        await send_text(receipient, incomming_message)
 
 ################################################################################
 #                          User-Related Helper Functions
 ################################################################################
-def _add_user_websocket_attributes(websocket: WebSocket):
+def _add_user_websocket_attributes(websocket: WebSocket, tenant_id: str):
     """
     This funciton will add special new fields to the websocket instance.
 
@@ -121,10 +178,16 @@ def _add_user_websocket_attributes(websocket: WebSocket):
         websocket.connection_type: ConnectionType = ConnectionType.USER
         websocket.chat_mode: ChatMode = ChatMode.USER_AI
         websocket.receipient_websocket: Websocket = None
+        websocket.conn_id: str = None
+        websocket.session_id: str = <new uuid>, identifies the transcript
+        websocket.tenant_id: str = tenant_id, resolved from the request
     """
     websocket.connection_type = ConnectionType.USER
     websocket.chat_mode  = ChatMode.USER_AI
     websocket.receipient_websocket = None
+    websocket.conn_id = None
+    websocket.session_id = str(uuid.uuid4())
+    websocket.tenant_id = tenant_id
 
 async def _check_modify_current_conversation_state(incomming_message:str, websocket: WebSocket):
     """
@@ -143,13 +206,45 @@ async def _check_modify_current_conversation_state(incomming_message:str, websoc
     
     if incomming_message == "SWITCH":
         websocket.chat_mode = ChatMode.USER_AGENT # From now on the user should talk to Agent
-        await connection_manager.add_connection(websocket)
+        await _add_to_waiting_queue(websocket)
+
+async def _add_to_waiting_queue(websocket: WebSocket):
+    """
+    Puts the user into the waiting queue and tells them their conn_id. Every
+    time the user is queued they get a new one. It is what the user passes as
+    `resume` after a restart (drain or crash) to keep their place.
+    """
+    await connection_manager.add_connection(websocket)
+    await send_text(websocket, f"You are in the queue. If the connection drops, reconnect with resume={websocket.conn_id} to keep your place") # System message
+
+async def _resume_waiting_position(websocket: WebSocket, conn_id: str, tenant_ids: List[str]):
+    """
+    Puts the user back to the place in the queue they had before the previous
+    server was drained. Does nothing if there is no such place, or if it is
+    in a tenant the user is not allowed to use (tenant_ids).
+    """
+    if await connection_manager.resume_connection(websocket, conn_id, tenant_ids):
+        websocket.chat_mode = ChatMode.USER_AGENT
+        await send_text(websocket, "Welcome back! You kept your place in the queue") # System message
+
+def _queue_status_text(websocket: WebSocket) -> str:
+    """
+    Position of the user in the queue and the estimated wait, as text
+    """
+    status = queue_status.get_status(websocket.app.state.connections, websocket)
+    if status is None:
+        return ""
+    text = f" You are number {status['position']} in the queue."
+    if status["eta_seconds"] is not None:
+        text += f" Estimated wait: {status['eta_seconds']} seconds."
+    return text
 
 async def _user_disconnect_cleanup(websocket: WebSocket):
     """
     Perform cleanup for user connection
     """
     if websocket.receipient_websocket:
+        await connection_manager.end_session(websocket)
         websocket.receipient_websocket.receipient_websocket = None
         websocket.receipient_websocket = None
     await connection_manager.remove_connection(websocket.app.state.connections, websocket)
@@ -158,21 +253,23 @@ async def _notify_user_about_agent_disconnect(websocket: WebSocket):
     """
     Will be shown if an agent closed the connection
     """
-    await websocket.send_text("Agent terminated conversation. You will be connected to the next available agent") # System message
+    await send_text(websocket, "Agent terminated conversation. You will be connected to the next available agent") # System message
 
 ################################################################################
 #                          Agent-Related Helper Functions
 ################################################################################
-def _add_agent_websocket_attributes(websocket: WebSocket):
+def _add_agent_websocket_attributes(websocket: WebSocket, tenant_ids: List[str]):
     """
     This funciton will add special new fields to the websocket instance.
 
     Here are the fields that will be added:
         websocket.connection_type: ConnectionType = ConnectionType.AGENT
         websocket.receipient_websocket: Websocket = None
+        websocket.tenant_ids: List[str] = tenant_ids, resolved from the request
     """
     websocket.connection_type = ConnectionType.AGENT
     websocket.receipient_websocket = None
+    websocket.tenant_ids = tenant_ids
 
 async def _agent_establish_connection(websocket: WebSocket,  app: FastAPI,  timeout_seconds: int = 60) -> Optional[WebSocket]:
     """
@@ -185,6 +282,10 @@ async def _agent_establish_connection(websocket: WebSocket,  app: FastAPI,  time
     connections = app.state.connections
 
     while total_waited < timeout_seconds:
+        if drain_manager.draining:
+            # Server is restarting, agent should look for connections elsewhere
+            return None
+
         result = await connection_manager.establish_connection(websocket, connections)
         if result is not None:
             return result
@@ -201,8 +302,8 @@ async def _close_receipient_websocket_connection(websocket: WebSocket):
     when agent did not directly close the connection, but that is the result of
     user's actions.
     """
-    await websocket.send_text("User disconnected. Goodbye") # System message
-    await websocket.close(code=1000, reason="User disconnected")
+    await send_text(websocket, "User disconnected. Goodbye") # System message
+    await close(websocket, code=1000, reason="User disconnected")
 
 async def _agent_disconnect_cleanup(websocket: WebSocket):
     """
@@ -0,0 +1,144 @@
+"""
+Optional per-connection message coalescing.
+
+Every send_text turns into its own WebSocket frame (and a transport write).
+Bursty senders (agents pasting text, AI token streams) end up producing a lot
+of tiny frames. A client can opt in to batching by connecting with the
+`batch_ms` query parameter, e.g. ws://127.0.0.1:8080/hh/user?batch_ms=5
+
+When batching is enabled, messages are buffered for up to `batch_ms`
+milliseconds (or until `max_bytes` are buffered) and then sent as a single
+frame containing a JSON array of the buffered messages:
+    ["message 1", "message 2", ...]
+
+Flush-on-idle guarantee: a message is never kept in the buffer for longer than
+the batching window, even if nothing else is sent afterwards.
+"""
+import asyncio
+import json
+
+from fastapi import WebSocket
+from typing import List, Optional
+
+MAX_BATCH_MS = 50 # Upper bound for the window a client can ask for
+DEFAULT_MAX_BYTES = 16 * 1024
+
+
+class MessageBatcher():
+    def __init__(self, websocket: WebSocket, window_ms: int, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        self.websocket = websocket
+        self.window = window_ms / 1000
+        self.max_bytes = max_bytes
+
+        self.pending: List[str] = []
+        self.pending_bytes = 0
+        self.flush_task: Optional[asyncio.Task] = None
+        self.send_lock = asyncio.Lock()
+
+        # Stats
+        self.messages_sent = 0
+        self.frames_sent = 0
+
+    async def send_text(self, message: str) -> None:
+        """
+        Buffers the message. The buffer is flushed right away if it grew over
+        max_bytes, otherwise a flush is scheduled at the end of the window.
+        """
+        self.pending.append(message)
+        self.pending_bytes += len(message.encode())
+
+        if self.pending_bytes >= self.max_bytes:
+            await self.flush()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def flush(self) -> None:
+        """
+        Sends all buffered messages as one frame
+        """
+        self._cancel_flush_task()
+        async with self.send_lock:
+            if not self.pending:
+                return
+            batch, self.pending, self.pending_bytes = self.pending, [], 0
+            await self.websocket.send_text(json.dumps(batch))
+            self.messages_sent += len(batch)
+            self.frames_sent += 1
+
+    async def close(self) -> None:
+        """
+        Flushes whatever is left in the buffer. Should be called before the
+        websocket is closed.
+        """
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f"Error flushing batched messages: {e}")
+
+    def discard(self) -> None:
+        """
+        Drops the buffer without sending it. Should be called once the client
+        has already disconnected.
+        """
+        self._cancel_flush_task()
+        self.pending, self.pending_bytes = [], 0
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.window)
+        self.flush_task = None # Do not cancel ourselves from flush()
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f"Error flushing batched messages: {e}")
+
+    def _cancel_flush_task(self) -> None:
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+
+
+def enable_batching(websocket: WebSocket, batch_ms: int) -> None:
+    """
+    Enables batching for the websocket if the client asked for it.
+
+    Args:
+        websocket (WebSocket) - accepted websocket connection
+        batch_ms (int) - batching window in milliseconds. 0 disables batching
+    """
+    websocket.batcher = None
+    if batch_ms > 0:
+        websocket.batcher = MessageBatcher(websocket, min(batch_ms, MAX_BATCH_MS))
+
+async def send_text(websocket: WebSocket, message: str) -> None:
+    """
+    Sends the message through the batcher of the websocket, if it has one.
+    Use this instead of websocket.send_text for connections that may batch.
+    """
+    batcher = getattr(websocket, "batcher", None)
+    if batcher is None:
+        await websocket.send_text(message)
+    else:
+        await batcher.send_text(message)
+
+async def flush(websocket: WebSocket) -> None:
+    """
+    Flushes buffered messages of the websocket, if it batches them
+    """
+    batcher = getattr(websocket, "batcher", None)
+    if batcher is not None:
+        await batcher.close()
+
+def discard(websocket: WebSocket) -> None:
+    """
+    Drops buffered messages of a websocket that has already disconnected
+    """
+    batcher = getattr(websocket, "batcher", None)
+    if batcher is not None:
+        batcher.discard()
+
+async def close(websocket: WebSocket, code: int = 1000, reason: Optional[str] = None) -> None:
+    """
+    Flushes buffered messages and closes the websocket
+    """
+    await flush(websocket)
+    await websocket.close(code=code, reason=reason)
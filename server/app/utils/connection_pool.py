@@ -1,5 +1,7 @@
+import time
+
 from collections import OrderedDict
-from typing import Dict, Optional
+from typing import Dict, Iterable, List, Optional
 
 # Do improvements in O-time in this case come with the space-complexity?
 #
@@ -84,41 +86,197 @@ from typing import Dict, Optional
 # time. And we can use the ordered dict for finding a particular connection in 
 # a list, also in O(1) time.
 
+# Handing the queue over to another process (drain mode):
+#
+# When a process is drained, the order of its waiting pool is exported as
+# tenant_id -> [conn_id, ...]. The successor imports it as reservations:
+# connections without data (no websocket yet) that keep the place in the queue.
+# When the user reconnects with their conn_id, the reservation is claimed in
+# O(1) and the user gets their old place back.
+#
+# Reservations that were not claimed expire. get_next_connection skips the
+# reservations that are not expired yet, which is O(r), but r is only non-zero
+# for a short time after a deploy.
+
+# Queue positions:
+#
+# OrderedDict gives us the order, but not the position of a connection in it.
+# Finding it by iterating is O(n), which is too much to answer every waiting
+# user. Every connection gets an arrival sequence number within its tenant
+# instead, and a Fenwick tree over the sequence numbers keeps 1 for waiting and
+# 0 for removed connections. Position = prefix sum up to the sequence number.
+# Insertion: O(log n)
+# Deletion: O(log n)
+# Position: O(log n)
+#
+# Sequence numbers only grow, so when they run out of the tree capacity, the
+# waiting connections are renumbered 1..n and the tree is rebuilt with twice
+# that capacity in O(n). That keeps the memory O(n) and the amortized
+# insertion O(log n).
+
 class Connection:
-    def __init__(self, conn_id: str, tenant_id: str, data:any):
+    def __init__(self, conn_id: str, tenant_id: str, data:any, expires_at: Optional[float] = None):
         self.conn_id = conn_id
         self.tenant_id = tenant_id
         self.data = data
+        self.expires_at = expires_at # Only set for reservations
+        self.seq = 0 # Arrival sequence number within the tenant
+
+    @property
+    def is_reservation(self) -> bool:
+        return self.data is None
 
     def __repr__(self):
         return f"<Connection id={self.conn_id} tenant={self.tenant_id}>"
 
-class WaitingPool:
+class RankIndex:
+    """Fenwick tree over the arrival sequence numbers of a tenant queue."""
+    MIN_CAPACITY = 16
+
     def __init__(self):
+        self.tree: List[int] = [0] * (self.MIN_CAPACITY + 1) # 1-based
+        self.next_seq = 1
+
+    @property
+    def is_full(self) -> bool:
+        return self.next_seq >= len(self.tree)
+
+    def add(self) -> int:
+        """Mark the next sequence number as waiting and return it."""
+        seq = self.next_seq
+        self.next_seq += 1
+        self._update(seq, 1)
+        return seq
+
+    def remove(self, seq: int):
+        self._update(seq, -1)
+
+    def rank(self, seq: int) -> int:
+        """Number of waiting connections with sequence number <= seq."""
+        total = 0
+        while seq > 0:
+            total += self.tree[seq]
+            seq -= seq & -seq
+        return total
+
+    def rebuild(self, conns: Iterable[Connection]):
+        """Renumber the waiting connections (in order) and rebuild the tree. O(n)"""
+        conns = list(conns)
+        capacity = max(self.MIN_CAPACITY, 2 * len(conns))
+        self.tree = [0] * (capacity + 1)
+        for seq, conn in enumerate(conns, start=1):
+            conn.seq = seq
+            self.tree[seq] = 1
+        for seq in range(1, capacity + 1):
+            parent = seq + (seq & -seq)
+            if parent <= capacity:
+                self.tree[parent] += self.tree[seq]
+        self.next_seq = len(conns) + 1
+
+    def _update(self, seq: int, delta: int):
+        while seq < len(self.tree):
+            self.tree[seq] += delta
+            seq += seq & -seq
+
+class WaitingPool:
+    def __init__(self, store=None):
         self.pool: Dict[str, OrderedDict[str, Connection]] = {}
+        self.ranks: Dict[str, RankIndex] = {} # tenant_id -> positions index
+        self.reservations: Dict[str, str] = {} # conn_id -> tenant_id
+        self.store = store # Optional StateStore, records every change of the pool
 
     def add_connection(self, conn: Connection):
         """Add a new user connection to the waiting pool."""
         if conn.tenant_id not in self.pool:
             self.pool[conn.tenant_id] = OrderedDict()
+            self.ranks[conn.tenant_id] = RankIndex()
+        rank_index = self.ranks[conn.tenant_id]
+        if rank_index.is_full:
+            rank_index.rebuild(self.pool[conn.tenant_id].values())
+        conn.seq = rank_index.add()
         self.pool[conn.tenant_id][conn.conn_id] = conn
+        if conn.is_reservation:
+            self.reservations[conn.conn_id] = conn.tenant_id
+        if self.store:
+            self.store.record("pool_add", conn.tenant_id, conn.conn_id)
 
     def remove_connection(self, tenant_id: str, conn_id: str) -> bool:
         """Remove a specific connection from the pool."""
         tenant_bucket = self.pool.get(tenant_id)
         if tenant_bucket and conn_id in tenant_bucket:
-            del tenant_bucket[conn_id]
+            conn = tenant_bucket.pop(conn_id)
+            self.ranks[tenant_id].remove(conn.seq)
+            self.reservations.pop(conn_id, None)
             if not tenant_bucket:
                 del self.pool[tenant_id]  # Clean up empty bucket
+                del self.ranks[tenant_id]
+            if self.store:
+                self.store.record("pool_remove", tenant_id, conn_id)
             return True
         return False
 
+    def contains(self, tenant_id: str, conn_id: str) -> bool:
+        """Check if the connection is waiting in the pool."""
+        return conn_id in self.pool.get(tenant_id, ())
+
+    def get_position(self, tenant_id: str, conn_id: str) -> Optional[int]:
+        """Position (1-based) of the connection in the tenant queue. O(log n)"""
+        tenant_bucket = self.pool.get(tenant_id)
+        if not tenant_bucket or conn_id not in tenant_bucket:
+            return None
+        return self.ranks[tenant_id].rank(tenant_bucket[conn_id].seq)
+
     def get_next_connection(self, tenant_id: str) -> Optional[Connection]:
         """Get the oldest waiting user for a tenant."""
+        self._remove_expired_reservations(tenant_id)
         tenant_bucket = self.pool.get(tenant_id)
         if tenant_bucket:
-            return next(iter(tenant_bucket.values()))
+            for conn in tenant_bucket.values():
+                if not conn.is_reservation:
+                    return conn
         return None
 
+    def export(self) -> Dict[str, List[str]]:
+        """Export the order of the waiting connections of every tenant."""
+        return {tenant_id: list(tenant_bucket) for tenant_id, tenant_bucket in self.pool.items()}
+
+    def import_reservations(self, queues: Dict[str, List[str]], ttl_seconds: float) -> int:
+        """
+        Reserve places for the connections exported by another process.
+        Reservations are placed after the connections already waiting.
+        """
+        expires_at = time.monotonic() + ttl_seconds
+        imported = 0
+        for tenant_id, conn_ids in queues.items():
+            for conn_id in conn_ids:
+                if not self.contains(tenant_id, conn_id):
+                    self.add_connection(Connection(conn_id, tenant_id, None, expires_at))
+                    imported += 1
+        return imported
+
+    def claim_reservation(self, conn_id: str, data: any, tenant_ids: Optional[Iterable[str]] = None) -> Optional[Connection]:
+        """
+        Fill the reservation with the reconnected user. O(1)
+        If tenant_ids are given, only a reservation of one of them is claimed.
+        """
+        tenant_id = self.reservations.get(conn_id)
+        if tenant_id is None or (tenant_ids is not None and tenant_id not in tenant_ids):
+            return None
+        del self.reservations[conn_id]
+        conn = self.pool[tenant_id][conn_id]
+        conn.data = data
+        conn.expires_at = None
+        return conn
+
+    def _remove_expired_reservations(self, tenant_id: str):
+        tenant_bucket = self.pool.get(tenant_id)
+        now = time.monotonic()
+        while tenant_bucket:
+            conn = next(iter(tenant_bucket.values()))
+            if not conn.is_reservation or conn.expires_at > now:
+                break
+            self.remove_connection(tenant_id, conn.conn_id)
+            tenant_bucket = self.pool.get(tenant_id)
+
     def __repr__(self):
         return f"<WaitingPool tenants={list(self.pool.keys())}>"
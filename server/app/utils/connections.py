@@ -4,40 +4,102 @@ Connection manager that allows to keep track of all connections open
 import asyncio
 
 from fastapi import WebSocket
-from typing import List 
+from typing import Dict, List, Set
+
+from utils.batching import send_text
+
+DEFAULT_TOPIC = "global"
+
+# Topics (rooms) are kept per tenant, the same way WaitingPool buckets its
+# connections by tenant_id. Publishing to a topic is then:
+#   tenant_id -> topic -> set of subscribers   O(1) lookup + O(s) fan-out
+# where s is the number of subscribers of that topic, not the number of all
+# connections on the server.
+#
+# Every websocket also remembers which topics it is subscribed to, so that
+# disconnecting costs O(t) (t - topics of that connection) instead of scanning
+# every room.
 
 
 class ConnectionManager():
     def __init__(self) -> None:
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Set[WebSocket] = set()
+        self.topics: Dict[str, Dict[str, Set[WebSocket]]] = {}
 
-    async def connect(self, websocket: WebSocket) -> None:
+    async def connect(self, websocket: WebSocket, tenant_id: str) -> None:
         """
-        Add the new websocket connection to the list of active connections
+        Add the new websocket connection to the list of active connections.
+
+        The connection is subscribed to the tenant's default topic, so that
+        clients that never send a subscribe message keep the old behaviour.
         """
         await websocket.accept()
-        self.active_connections.append(websocket)
+        websocket.tenant_id = tenant_id
+        websocket.topics = set()
+        self.active_connections.add(websocket)
+        self.subscribe(websocket, DEFAULT_TOPIC)
         print("Added new connection")
 
     def disconnect(self, websocket: WebSocket) -> None:
         """
-        Remove a websocket connection from the list of active connections.
-
-        Check before calling this function that the websocket was added to the
-        list of active connections
+        Remove a websocket connection from the list of active connections and
+        from every topic it is subscribed to.
         """
-        self.active_connections.remove(websocket)
+        for topic in list(getattr(websocket, "topics", ())):
+            self.unsubscribe(websocket, topic)
+        self.active_connections.discard(websocket)
         print("Removed connection")
 
+    def subscribe(self, websocket: WebSocket, topic: str) -> None:
+        """
+        Subscribe the connection to a topic of its tenant
+        """
+        tenant_topics = self.topics.setdefault(websocket.tenant_id, {})
+        tenant_topics.setdefault(topic, set()).add(websocket)
+        websocket.topics.add(topic)
+
+    def unsubscribe(self, websocket: WebSocket, topic: str) -> bool:
+        """
+        Unsubscribe the connection from a topic of its tenant.
+
+        Returns False if the connection was not subscribed to that topic.
+        """
+        tenant_topics = self.topics.get(websocket.tenant_id)
+        if not tenant_topics or websocket not in tenant_topics.get(topic, ()):
+            return False
+
+        subscribers = tenant_topics[topic]
+        subscribers.discard(websocket)
+        websocket.topics.discard(topic)
+        if not subscribers:
+            del tenant_topics[topic]  # Clean up empty topic
+            if not tenant_topics:
+                del self.topics[websocket.tenant_id]  # Clean up empty tenant
+        return True
+
+    def get_subscribers(self, tenant_id: str, topic: str) -> List[WebSocket]:
+        """
+        Returns the subscribers of the topic for the given tenant
+        """
+        return list(self.topics.get(tenant_id, {}).get(topic, ()))
+
+    async def publish(self, tenant_id: str, topic: str, message: str) -> None:
+        """
+        Sends the message only to the connections subscribed to the topic
+        """
+        await self._send_all(self.get_subscribers(tenant_id, topic), message)
+
     async def broadcast(self, message:str) -> None:
         """
-        Sends the message to all active connections
+        Sends the message to all active connections, regardless of tenant or
+        topic. Should be used for server-wide announcements only.
         """
+        await self._send_all(list(self.active_connections), message)
+
+    async def _send_all(self, connections: List[WebSocket], message: str) -> None:
         # Using task buffer for better asynchronous code
         tasks = []
-        for connection in self.active_connections:
-            tasks.append(connection.send_text(message))
+        for connection in connections:
+            tasks.append(send_text(connection, message))
 
         await asyncio.gather(*tasks, return_exceptions=True)
-
-
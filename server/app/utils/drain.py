@@ -0,0 +1,157 @@
+"""
+Drain mode for zero-downtime deploys.
+
+Without draining, a restart drops every socket: active human handover sessions
+are lost and every waiting user loses their place in the queue.
+
+When the process is drained:
+    1. New websocket connections are rejected (closed with code 1012, service
+       restart), so the load balancer sends them to another process.
+    2. The order of the waiting pool is exported.
+    3. Idle connections are told to reconnect and closed. Waiting users get
+       their conn_id, which they can pass as `resume` when they reconnect to
+       keep their place in the queue.
+    4. Active user-agent sessions get up to `timeout` seconds to finish.
+       Sessions still running after that are moved: the users are put to the
+       front of the exported queue and told to reconnect as well.
+
+The exported queue is imported by the successor (POST /admin/queue, or through
+the drain file, see WS_DRAIN_FILE).
+"""
+import asyncio
+import json
+import time
+
+from fastapi import FastAPI, WebSocket
+from typing import Dict, List, Optional, Set
+
+from utils.batching import send_text, close
+from utils.enums import ConnectionType
+
+SERVICE_RESTART = 1012 # Websocket close code
+
+
+class DrainManager():
+    def __init__(self) -> None:
+        self.draining = False
+        self.done = False
+        self.connections: Set[WebSocket] = set()
+        self.queue: Dict[str, List[str]] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    def register(self, websocket: WebSocket) -> None:
+        """
+        Track the accepted websocket connection, so it can be drained
+        """
+        self.connections.add(websocket)
+
+    def unregister(self, websocket: WebSocket) -> None:
+        self.connections.discard(websocket)
+
+    async def reject(self, websocket: WebSocket) -> None:
+        """
+        Reject a new connection while draining. Should be called before the
+        websocket is accepted. The connection is accepted and closed right
+        away, because closing during the handshake is turned into an HTTP 403
+        and the client would never see the close code.
+        """
+        await websocket.accept()
+        await websocket.close(code=SERVICE_RESTART, reason="Server is restarting")
+
+    def start(self, app: FastAPI, timeout: float, export_file: Optional[str] = None) -> None:
+        """
+        Start draining in the background. Does nothing if already draining.
+        """
+        if not self.draining:
+            self.draining = True
+            self.task = asyncio.create_task(self.drain(app, timeout, export_file))
+
+    async def drain(self, app: FastAPI, timeout: float, export_file: Optional[str] = None) -> Dict[str, List[str]]:
+        """
+        Drain all connections. Returns the exported queue.
+        """
+        self.draining = True
+        pool = app.state.connections
+        self.queue = pool.export()
+
+        # Idle connections can go right away
+        await self._release([ws for ws in self.connections if not self._is_busy(ws)], pool)
+
+        # Give active sessions some time to finish
+        deadline = time.monotonic() + timeout
+        while any(self._is_busy(ws) for ws in self.connections) and time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+            await self._release([ws for ws in self.connections if not self._is_busy(ws)], pool)
+
+        # Move the sessions that did not finish to the front of the queue
+        moved: Dict[str, List[str]] = {}
+        for websocket in list(self.connections):
+            if self._is_busy(websocket) and websocket.connection_type is ConnectionType.USER:
+                moved.setdefault(websocket.tenant_id, []).append(websocket.conn_id)
+        for tenant_id, conn_ids in moved.items():
+            self.queue[tenant_id] = conn_ids + self.queue.get(tenant_id, [])
+        await self._release(list(self.connections), pool)
+
+        if export_file:
+            with open(export_file, "w") as f:
+                json.dump(self.queue, f)
+        self.done = True
+        print(f"Drain finished. Exported {sum(len(ids) for ids in self.queue.values())} waiting connections")
+        return self.queue
+
+    def status(self) -> dict:
+        return {
+            "draining": self.draining,
+            "done": self.done,
+            "connections": len(self.connections),
+            "active_sessions": sum(1 for ws in self.connections if self._is_busy(ws)),
+            "queue": self.queue if self.done else None,
+        }
+
+    def _is_busy(self, websocket: WebSocket) -> bool:
+        """
+        Busy connections are the ones in an active user-agent session
+        """
+        return getattr(websocket, "receipient_websocket", None) is not None
+
+    async def _release(self, websockets: List[WebSocket], pool) -> None:
+        """
+        Tell the connections to reconnect elsewhere and close them
+        """
+        queued = {conn_id for conn_ids in self.queue.values() for conn_id in conn_ids}
+        for websocket in websockets:
+            self.unregister(websocket)
+            resume = self._get_resume_id(websocket, pool, queued)
+            if resume and resume not in queued:
+                # Started waiting after the queue was exported
+                self.queue.setdefault(websocket.tenant_id, []).append(resume)
+                queued.add(resume)
+            if self._is_busy(websocket):
+                # Unlink the session, so that closing one side does not make
+                # the endpoint of the other side close it as well
+                websocket.receipient_websocket.receipient_websocket = None
+                websocket.receipient_websocket = None
+            try:
+                await send_text(websocket, json.dumps({
+                    "type": "reconnect",
+                    "message": "Server is restarting. Please reconnect",
+                    "resume": resume
+                }))
+                await close(websocket, code=SERVICE_RESTART, reason="Server is restarting")
+            except Exception as e:
+                print(f"Error closing websocket while draining: {e}")
+
+    def _get_resume_id(self, websocket: WebSocket, pool, queued: Set[str]) -> Optional[str]:
+        """
+        Users that are waiting in the pool (or were moved to the front of the
+        exported queue) get their conn_id to resume with
+        """
+        conn_id = getattr(websocket, "conn_id", None)
+        if conn_id is None:
+            return None
+        if pool.contains(websocket.tenant_id, conn_id) or conn_id in queued:
+            return conn_id
+        return None
+
+
+drain_manager = DrainManager()
@@ -6,13 +6,18 @@ import asyncio
 import uuid
 
 from fastapi import WebSocket
-from typing import Optional
+from typing import List, Optional
+from config import settings
 from utils.connection_pool import Connection
+from utils.persistence import state_store
+from utils.queue_status import queue_status
+from utils.tenants import TenantScheduler
 
 
 class ConnectionManager():
     def __init__(self) -> None:
         self.connection_lock = asyncio.Lock()
+        self.scheduler = TenantScheduler(settings.tenant_weights)
 
     def _generate_connection_id(self) -> str:
         """
@@ -20,19 +25,34 @@ class ConnectionManager():
         """
         return str(uuid.uuid4())
 
-    async def add_connection(self, websocket: WebSocket, tenant_id:str = "tenant_123") -> None:
+    async def add_connection(self, websocket: WebSocket) -> None:
         """
         Add the new websocket connection to the list of current connections.
-        Now, this method connection to an active wait list.
+        Now, this method connection to an active wait list of the tenant of
+        the websocket (websocket.tenant_id).
         """
         pool = websocket.app.state.connections
         conn_id = self._generate_connection_id()
 
         websocket.conn_id = conn_id
-        websocket.tenant_id = tenant_id
-        pool.add_connection(Connection(conn_id, tenant_id, websocket))
+        pool.add_connection(Connection(conn_id, websocket.tenant_id, websocket))
 
+    async def resume_connection(self, websocket: WebSocket, conn_id: str, tenant_ids: List[str]) -> bool:
+        """
+        Puts the websocket into the place in the waiting list that was reserved
+        for it (see WaitingPool.import_reservations). Only a reservation of one
+        of the tenants the connection is allowed to use (tenant_ids) is taken.
+
+        Returns False if there was no such reservation for the conn_id.
+        """
+        pool = websocket.app.state.connections
+        conn = pool.claim_reservation(conn_id, websocket, tenant_ids)
+        if conn is None:
+            return False
 
+        websocket.conn_id = conn.conn_id
+        websocket.tenant_id = conn.tenant_id
+        return True
 
     async def remove_connection(self, connections, websocket: WebSocket):
         """
@@ -47,12 +67,21 @@ class ConnectionManager():
             if conn_id:
                  pool.remove_connection(tenant_id, conn_id)
 
-    async def establish_connection(self, agent_websocket: WebSocket, connections, tenant_id:str = "tenant_123") -> Optional[WebSocket]:
+    async def end_session(self, user_websocket: WebSocket) -> None:
+        """
+        Should be called when the user stops talking to the agent, before the
+        user is added to the waiting list again.
+        """
+        state_store.record("unpair", user_websocket.conn_id)
+
+    async def establish_connection(self, agent_websocket: WebSocket, connections) -> Optional[WebSocket]:
         """
         Attempts to connect two websockets together.
 
         If the system finds a user for the agent, they will be linked.
-        The return value will be that user's Websocket.
+        The return value will be that user's Websocket. The user is taken from
+        one of the agent's tenants (agent_websocket.tenant_ids), chosen by
+        weighted fair queuing.
 
         If no link was established, agent recieves None.
         """
@@ -62,12 +91,18 @@ class ConnectionManager():
             return None
         
         pool = connections
-        next_conn = pool.get_next_connection(tenant_id)
-        if next_conn:
+        for tenant_id in self.scheduler.order_tenants(agent_websocket.tenant_ids, pool):
+            next_conn = pool.get_next_connection(tenant_id)
+            if next_conn is None:
+                continue # Only reservations are waiting
+
             user_websocket = next_conn.data
 
             user_websocket.receipient_websocket = agent_websocket
             agent_websocket.receipient_websocket = user_websocket
+            state_store.record("pair", user_websocket.tenant_id, user_websocket.conn_id)
+            queue_status.record_pickup(tenant_id)
+            self.scheduler.served(tenant_id)
 
             await self.remove_connection(connections=connections,\
                                          websocket=user_websocket)
@@ -0,0 +1,307 @@
+"""
+Persistence of the in-memory state to a local directory.
+
+WaitingPool, handover pairings and pending chat requests only exist in memory,
+so a crash loses every queued customer. To avoid that, every change of that
+state is written to a write-ahead log (WAL) and periodically compacted into a
+snapshot:
+
+    <state dir>/snapshot.json  - full state + sequence number of the last record
+    <state dir>/wal.jsonl      - one JSON record per line, appended after the snapshot
+
+The event loop never touches the disk. record() only puts the change into a
+queue (one enqueue on the hot path). A background thread takes the records
+from the queue in batches, appends them to the WAL with a single write and a
+single fsync per batch (group commit), and applies them to its own copy of the
+state. That copy is what the snapshot is written from, so taking a snapshot
+does not need anything from the event loop either.
+
+Recovery = load snapshot + replay WAL records with a newer sequence number.
+
+Write errors (disk full, permissions) do not stop the writer thread. A batch
+that could not be written is kept and retried (together with the newer
+records) every `retry_interval` seconds, and the WAL is cut back to where it
+was, so a torn write can not hide the records written after it. A snapshot
+that could not be written is retried as well. Errors and the records that are
+not on disk yet are reported by metrics() (GET /admin/state).
+
+Records:
+    ("pool_add", tenant_id, conn_id)
+    ("pool_remove", tenant_id, conn_id)
+    ("pair", tenant_id, conn_id)            - user conn_id is talking to an agent
+    ("unpair", conn_id)
+    ("chat_request", receiver_id, sender_id)
+    ("chat_request_pop", receiver_id)
+    ("chat_user_remove", user_id)
+"""
+import json
+import os
+import queue
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+SNAPSHOT_FILE = "snapshot.json"
+WAL_FILE = "wal.jsonl"
+RETRY_INTERVAL = 1.0 # Seconds between retries of a failed write
+
+
+class StoreState():
+    """
+    State that is persisted. Mirrors the in-memory state, but only keeps ids
+    """
+    def __init__(self) -> None:
+        self.pool: Dict[str, OrderedDict[str, None]] = {}
+        self.pairs: Dict[str, str] = {} # conn_id -> tenant_id
+        self.chat_requests: Dict[str, List[str]] = {} # receiver_id -> sender_ids
+        self.seq = 0 # Sequence number of the last applied record
+
+    def apply(self, op: str, args: list) -> None:
+        """
+        Applies a single record. Unknown records are ignored.
+        """
+        if op == "pool_add":
+            tenant_id, conn_id = args
+            self.pool.setdefault(tenant_id, OrderedDict())[conn_id] = None
+        elif op == "pool_remove":
+            tenant_id, conn_id = args
+            tenant_bucket = self.pool.get(tenant_id)
+            if tenant_bucket is not None:
+                tenant_bucket.pop(conn_id, None)
+                if not tenant_bucket:
+                    del self.pool[tenant_id]
+        elif op == "pair":
+            tenant_id, conn_id = args
+            self.pairs[conn_id] = tenant_id
+        elif op == "unpair":
+            self.pairs.pop(args[0], None)
+        elif op == "chat_request":
+            receiver_id, sender_id = args
+            self.chat_requests.setdefault(receiver_id, []).append(sender_id)
+        elif op == "chat_request_pop":
+            requests = self.chat_requests.get(args[0])
+            if requests:
+                requests.pop(0)
+                if not requests:
+                    del self.chat_requests[args[0]]
+        elif op == "chat_user_remove":
+            self.chat_requests.pop(args[0], None)
+
+    def waiting_queues(self) -> Dict[str, List[str]]:
+        """
+        Order in which users should get their places back after a restart.
+        Users that were talking to an agent go first, then the waiting ones.
+        """
+        queues: Dict[str, List[str]] = {}
+        for conn_id, tenant_id in self.pairs.items():
+            queues.setdefault(tenant_id, []).append(conn_id)
+        for tenant_id, tenant_bucket in self.pool.items():
+            queues.setdefault(tenant_id, []).extend(tenant_bucket)
+        return queues
+
+    def to_dict(self) -> dict:
+        return {
+            "seq": self.seq,
+            "pool": {tenant_id: list(tenant_bucket) for tenant_id, tenant_bucket in self.pool.items()},
+            "pairs": self.pairs,
+            "chat_requests": self.chat_requests,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "StoreState":
+        state = cls()
+        state.seq = data.get("seq", 0)
+        state.pool = {tenant_id: OrderedDict.fromkeys(conn_ids) for tenant_id, conn_ids in data.get("pool", {}).items()}
+        state.pairs = dict(data.get("pairs", {}))
+        state.chat_requests = {user_id: list(ids) for user_id, ids in data.get("chat_requests", {}).items()}
+        return state
+
+
+class StateStore():
+    def __init__(self) -> None:
+        self.directory: Optional[str] = None
+        self.records: queue.SimpleQueue = queue.SimpleQueue()
+        self.thread: Optional[threading.Thread] = None
+        self.fsync_interval = 0.05
+        self.snapshot_interval = 60.0
+
+        # Metrics, written by the writer thread
+        self.written = 0
+        self.unsaved = 0 # Records that could not be written yet
+        self.write_errors = 0
+        self.snapshot_errors = 0
+        self.last_error: Optional[str] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.thread is not None
+
+    def metrics(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "queued": self.records.qsize(),
+            "written": self.written,
+            "unsaved": self.unsaved,
+            "write_errors": self.write_errors,
+            "snapshot_errors": self.snapshot_errors,
+            "last_error": self.last_error,
+        }
+
+    def record(self, op: str, *args) -> None:
+        """
+        Records a change of the state. Called from the event loop, never blocks.
+        Does nothing if the store was not started.
+        """
+        if self.thread is not None:
+            self.records.put((op, args))
+
+    def load(self, directory: str) -> StoreState:
+        """
+        Recovers the state from the snapshot and the WAL in the directory
+        """
+        os.makedirs(directory, exist_ok=True)
+        state = StoreState()
+        snapshot_path = os.path.join(directory, SNAPSHOT_FILE)
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path) as f:
+                state = StoreState.from_dict(json.load(f))
+
+        wal_path = os.path.join(directory, WAL_FILE)
+        if os.path.exists(wal_path):
+            with open(wal_path) as f:
+                for line in f:
+                    try:
+                        seq, op, args = json.loads(line)
+                    except ValueError:
+                        break # Torn write at the end of the log
+                    if seq > state.seq:
+                        state.apply(op, args)
+                        state.seq = seq
+        return state
+
+    def start(self, directory: str, state: StoreState, fsync_interval: float = 0.05,
+              snapshot_interval: float = 60.0) -> None:
+        """
+        Writes a snapshot of the given state and starts the background writer.
+
+        Args:
+            directory (str) - where the snapshot and the WAL are kept
+            state (StoreState) - current state, usually what load() returned
+            fsync_interval (float) - seconds to collect records before a fsync
+            snapshot_interval (float) - seconds between snapshots
+        """
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.snapshot_interval = snapshot_interval
+        self._write_snapshot(state)
+
+        self.thread = threading.Thread(target=self._run, args=(state,), name="state-store", daemon=True)
+        self.thread.start()
+
+    def close(self) -> None:
+        """
+        Writes all queued records, takes a last snapshot and stops the writer
+        """
+        if self.thread is None:
+            return
+        self.records.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def _run(self, state: StoreState) -> None:
+        wal_path = os.path.join(self.directory, WAL_FILE)
+        last_snapshot = time.monotonic()
+        pending: List[str] = [] # WAL lines that are not on disk yet
+        running = True
+        while running:
+            batch = self._get_batch(timeout=RETRY_INTERVAL if pending else None)
+            if batch and batch[-1] is None:
+                running = False
+                batch.pop()
+
+            for op, args in batch:
+                state.seq += 1
+                state.apply(op, list(args))
+                pending.append(json.dumps([state.seq, op, args]) + "\n")
+            if pending and self._append(wal_path, pending):
+                self.written += len(pending)
+                pending = []
+
+            if not running or time.monotonic() - last_snapshot >= self.snapshot_interval:
+                try:
+                    self._write_snapshot(state)
+                    last_snapshot = time.monotonic()
+                    pending = [] # Part of the snapshot now
+                except OSError as e:
+                    self.snapshot_errors += 1
+                    self._report_error("writing the snapshot", e)
+            self.unsaved = len(pending)
+
+        if pending:
+            print(f"State store stopped with {len(pending)} records that could not be written")
+
+    def _get_batch(self, timeout: Optional[float]) -> list:
+        """
+        Waits for the next record (up to `timeout` seconds, None - forever) and
+        collects the records that come within `fsync_interval` after it.
+        None in the batch means the store is being closed.
+        """
+        try:
+            batch = [self.records.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.fsync_interval
+        while batch[-1] is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.records.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _append(self, wal_path: str, lines: List[str]) -> bool:
+        """
+        Appends the lines to the WAL with a single write and a single fsync.
+        On error the WAL is cut back to its previous size and False is returned.
+        """
+        size = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+        try:
+            with open(wal_path, "a") as wal:
+                wal.write("".join(lines))
+                wal.flush()
+                os.fsync(wal.fileno())
+            return True
+        except OSError as e:
+            self.write_errors += 1
+            self._report_error("writing the WAL", e)
+            try:
+                os.truncate(wal_path, size)
+            except OSError:
+                pass # Records after a torn line are written again with the next retry
+            return False
+
+    def _report_error(self, action: str, error: Exception) -> None:
+        self.last_error = f"{action}: {error}"
+        print(f"Error {action}, will retry: {error}")
+
+    def _write_snapshot(self, state: StoreState) -> None:
+        """
+        Atomically replaces the snapshot and truncates the WAL. Records in the
+        WAL are already part of the snapshot, so a crash between the two steps
+        is safe (they are skipped by their sequence number on recovery).
+        """
+        snapshot_path = os.path.join(self.directory, SNAPSHOT_FILE)
+        tmp_path = snapshot_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state.to_dict(), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, snapshot_path)
+        open(os.path.join(self.directory, WAL_FILE), "w").close()
+
+
+state_store = StateStore()
@@ -0,0 +1,190 @@
+"""
+Event loop lag and slow callback profiler.
+
+When latency spikes, we need to know what blocked the event loop: a slow
+send_text, a big json.dumps, or one of the O(n) scans. Two cheap parts:
+
+    1. A monitor task sleeps for `interval` and measures how late it woke up.
+       That is the event loop lag. Lag over `threshold` is a slow callback.
+    2. A watchdog thread checks if the monitor task is late. If it is, the
+       loop is blocked right now, so the watchdog takes a sample of the stack
+       of the event loop thread. The sample is attributed to the innermost
+       frame in routers/ (the router function that blocked the loop), or
+       utils/ if there is none.
+
+When the monitor task wakes up after a slow callback, the samples taken while
+the loop was blocked are turned into a slow callback record.
+
+Nothing is sampled while the loop is healthy, so it can be left on in
+production: one wake-up of the monitor per `interval` and one of the watchdog
+per threshold / 2.
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+
+from collections import Counter, deque
+from typing import Deque, Dict, List, Optional
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROUTERS_DIR = os.path.join(APP_DIR, "routers")
+
+
+class LoopProfiler():
+    def __init__(self) -> None:
+        self.interval = 0.1
+        self.threshold = 0.05
+        self.alpha = 0.1 # Weight of the newest lag in the EWMA
+
+        self.lag_ewma = 0.0
+        self.lag_max = 0.0
+        self.lag_last = 0.0
+        self.ticks = 0
+
+        self.slow_callbacks: Deque[dict] = deque(maxlen=50)
+        self.slow_callback_count = 0
+        self.functions: Dict[str, dict] = {} # function -> {"count": int, "seconds": float}
+
+        self.lock = threading.Lock()
+        self.current_samples: List[List[traceback.FrameSummary]] = []
+        self.last_tick = time.monotonic()
+        self.loop_thread_id: Optional[int] = None
+        self.task: Optional[asyncio.Task] = None
+        self.thread: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return self.task is not None
+
+    def start(self, interval: float = 0.1, threshold: float = 0.05) -> None:
+        """
+        Starts profiling the running event loop. Must be called from the loop.
+        """
+        self.interval = interval
+        self.threshold = threshold
+        self.loop_thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self.stop_event.clear()
+        self.task = asyncio.create_task(self._monitor())
+        self.thread = threading.Thread(target=self._watch, name="loop-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        if self.task is None:
+            return
+        self.task.cancel()
+        self.task = None
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+    def reset(self) -> None:
+        with self.lock:
+            self.lag_ewma = self.lag_max = self.lag_last = 0.0
+            self.ticks = 0
+            self.slow_callbacks.clear()
+            self.slow_callback_count = 0
+            self.functions = {}
+
+    def stats(self) -> dict:
+        with self.lock:
+            functions = sorted(self.functions.items(), key=lambda item: item[1]["seconds"], reverse=True)
+            return {
+                "enabled": self.enabled,
+                "interval_ms": self.interval * 1000,
+                "threshold_ms": self.threshold * 1000,
+                "lag_ms": {
+                    "ewma": self.lag_ewma * 1000,
+                    "max": self.lag_max * 1000,
+                    "last": self.lag_last * 1000,
+                },
+                "slow_callbacks": self.slow_callback_count,
+                "functions": [{"function": function, **totals} for function, totals in functions],
+                "recent": list(self.slow_callbacks),
+            }
+
+    async def _monitor(self) -> None:
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.last_tick = now
+            lag = max(0.0, now - expected)
+
+            with self.lock:
+                self.ticks += 1
+                self.lag_last = lag
+                self.lag_max = max(self.lag_max, lag)
+                self.lag_ewma = self.alpha * lag + (1 - self.alpha) * self.lag_ewma
+                samples, self.current_samples = self.current_samples, []
+                if lag >= self.threshold:
+                    self._record_slow_callback(lag, samples)
+
+    def _watch(self) -> None:
+        """
+        Runs in the watchdog thread
+        """
+        while not self.stop_event.wait(self.threshold / 2):
+            if time.monotonic() - self.last_tick < self.interval + self.threshold:
+                continue # Loop is healthy
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            with self.lock:
+                self.current_samples.append(stack)
+
+    def _record_slow_callback(self, lag: float, samples: List[List[traceback.FrameSummary]]) -> None:
+        """
+        Must be called with the lock held
+        """
+        self.slow_callback_count += 1
+        if samples:
+            functions = Counter(self._attribute(stack) for stack in samples)
+            function = functions.most_common(1)[0][0]
+            stack = samples[-1]
+        else:
+            function = "unknown" # Too short to be sampled
+            stack = []
+
+        totals = self.functions.setdefault(function, {"count": 0, "seconds": 0.0})
+        totals["count"] += 1
+        totals["seconds"] += lag
+        self.slow_callbacks.append({
+            "time": time.time(),
+            "lag_ms": lag * 1000,
+            "function": function,
+            "stack": [f"{self._short_path(frame.filename)}:{frame.lineno} in {frame.name}" for frame in stack[-10:]],
+        })
+
+    def _attribute(self, stack: List[traceback.FrameSummary]) -> str:
+        """
+        Innermost router function of the stack, or app function if none
+        """
+        app_frame = None
+        for frame in reversed(stack):
+            filename = os.path.abspath(frame.filename)
+            if filename.startswith(ROUTERS_DIR):
+                return f"{self._short_path(filename)}:{frame.name}"
+            if app_frame is None and filename.startswith(APP_DIR):
+                app_frame = frame
+        frame = app_frame or (stack[-1] if stack else None)
+        if frame is None:
+            return "unknown"
+        return f"{self._short_path(frame.filename)}:{frame.name}"
+
+    def _short_path(self, filename: str) -> str:
+        """
+        Path relative to the app, or package/module for libraries
+        """
+        filename = os.path.abspath(filename)
+        if filename.startswith(APP_DIR):
+            return os.path.relpath(filename, APP_DIR)
+        return os.path.join(*filename.split(os.sep)[-2:])
+
+
+loop_profiler = LoopProfiler()
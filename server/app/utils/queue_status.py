@@ -0,0 +1,116 @@
+"""
+Queue position and estimated wait time for the users waiting for an agent.
+
+Without it, a waiting user only sees "Please wait" whenever they type
+something, so users keep resending messages just to see if anything changed.
+
+Positions come from WaitingPool.get_position (O(log n)). The wait is estimated
+from an EWMA of the time between agent pickups of the tenant:
+    eta = position * pickup interval
+
+Updates are pushed periodically, tenant by tenant, and only to the users whose
+status (position or ETA) changed since the last push - not on every pickup.
+The last status is remembered per conn_id, so a user that is queued again
+(new conn_id) gets updates again even at the same position.
+"""
+import asyncio
+import json
+import time
+
+from fastapi import FastAPI, WebSocket
+from typing import Dict, Optional
+
+from utils.batching import send_text
+
+
+class QueueStatus():
+    def __init__(self, alpha: float = 0.2) -> None:
+        self.alpha = alpha # Weight of the newest pickup interval
+        self.pickup_interval: Dict[str, float] = {} # tenant_id -> EWMA in seconds
+        self.last_pickup: Dict[str, float] = {} # tenant_id -> monotonic time
+        self.task: Optional[asyncio.Task] = None
+
+    def record_pickup(self, tenant_id: str) -> None:
+        """
+        Should be called every time an agent picks up a user of the tenant
+        """
+        now = time.monotonic()
+        last = self.last_pickup.get(tenant_id)
+        if last is not None:
+            interval = now - last
+            previous = self.pickup_interval.get(tenant_id)
+            if previous is None:
+                self.pickup_interval[tenant_id] = interval
+            else:
+                self.pickup_interval[tenant_id] = self.alpha * interval + (1 - self.alpha) * previous
+        self.last_pickup[tenant_id] = now
+
+    def estimate_wait(self, tenant_id: str, position: int) -> Optional[float]:
+        """
+        Estimated seconds until the user on the position is picked up.
+        None until there were at least two pickups for the tenant.
+        """
+        interval = self.pickup_interval.get(tenant_id)
+        if interval is None:
+            return None
+        # If agents stopped picking up, the wait grows with the time since the last pickup
+        interval = max(interval, time.monotonic() - self.last_pickup[tenant_id])
+        return position * interval
+
+    def get_status(self, pool, websocket: WebSocket) -> Optional[dict]:
+        """
+        Position and ETA of the waiting user. None if the user is not waiting.
+        """
+        position = pool.get_position(websocket.tenant_id, websocket.conn_id)
+        if position is None:
+            return None
+        return self._status(websocket.tenant_id, position)
+
+    def start(self, app: FastAPI, interval: float) -> None:
+        """
+        Starts pushing the updates every `interval` seconds
+        """
+        if interval > 0:
+            self.task = asyncio.create_task(self._push_periodically(app, interval))
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def push(self, pool) -> None:
+        """
+        Sends the queue status to every waiting user whose status changed
+        """
+        for tenant_id, tenant_bucket in list(pool.pool.items()):
+            tasks = []
+            for position, conn in enumerate(list(tenant_bucket.values()), start=1):
+                websocket = conn.data
+                if websocket is None:
+                    continue # Reservation
+                status = self._status(tenant_id, position)
+                last_status = (conn.conn_id, status["position"], status["eta_seconds"])
+                if getattr(websocket, "last_queue_status", None) == last_status:
+                    continue # Nothing new to say
+                websocket.last_queue_status = last_status
+                tasks.append(send_text(websocket, json.dumps(status)))
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _push_periodically(self, app: FastAPI, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.push(app.state.connections)
+            except Exception as e:
+                print(f"Error pushing queue status: {e}")
+
+    def _status(self, tenant_id: str, position: int) -> dict:
+        eta = self.estimate_wait(tenant_id, position)
+        return {
+            "type": "queue_status",
+            "position": position,
+            "eta_seconds": round(eta) if eta is not None else None,
+        }
+
+
+queue_status = QueueStatus()
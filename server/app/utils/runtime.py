@@ -0,0 +1,160 @@
+"""
+Runtime profiles for starting the uvicorn server.
+
+"default" is what the app was always started with - a single process with the
+uvicorn defaults. Good for local development.
+
+"production" is tuned for many long-lived websocket connections:
+    - uvloop event loop and httptools HTTP parser (if they are installed)
+    - smaller max websocket message size, so a single client can not make the
+      server buffer 16MB messages (the uvicorn default)
+    - less frequent pings with a shorter timeout to find dead peers faster
+      without pinging idle connections every 20 seconds
+    - bigger listen backlog to survive reconnect storms
+    - several worker processes. With SO_REUSEPORT every worker binds its own
+      socket and the kernel load-balances incoming connections between them.
+
+Note on workers: every worker has its own app.state.connections (WaitingPool),
+chat state, topic subscriptions and drain state, and the kernel decides which
+worker gets a connection. An agent would only be matched with users that
+happen to be connected to the same worker. The workers would also share the
+state, drain and transcript files, which are written by a single process.
+So several workers are only allowed for the stateless routers (echo) and
+without those files. Anything else refuses to start with WS_WORKERS > 1.
+"""
+import importlib.util
+import multiprocessing
+import signal
+import socket
+
+import uvicorn
+
+from config import Settings
+
+APP = "main:app" # Import string is required by uvicorn to start workers
+
+# Routers that keep no state in the process, so their connections can be
+# spread over several workers
+STATELESS_ROUTERS = {"echo"}
+
+DEFAULT_PROFILE = {
+    "log_level": "info",
+}
+
+PRODUCTION_PROFILE = {
+    "loop": "uvloop",
+    "http": "httptools",
+    "ws": "websockets",
+    "ws_max_size": 1024 * 1024,
+    "ws_ping_interval": 30.0,
+    "ws_ping_timeout": 10.0,
+    "log_level": "warning",
+    "access_log": False,
+}
+
+PROFILES = {
+    "default": DEFAULT_PROFILE,
+    "production": PRODUCTION_PROFILE,
+}
+
+
+def get_profile(settings: Settings) -> dict:
+    """
+    Returns uvicorn keyword arguments for the configured profile.
+
+    Optional dependencies (uvloop, httptools) are replaced with the uvicorn
+    defaults when they are not installed (e.g. uvloop on Windows).
+    """
+    if settings.profile not in PROFILES:
+        raise ValueError(f"Unknown runtime profile {settings.profile}. Expected one of {list(PROFILES)}")
+
+    profile = dict(PROFILES[settings.profile])
+    for option, module in (("loop", "uvloop"), ("http", "httptools")):
+        if profile.get(option) == module and importlib.util.find_spec(module) is None:
+            print(f"{module} is not installed, falling back to uvicorn default")
+            profile[option] = "auto"
+
+    profile["host"] = settings.host
+    profile["port"] = settings.port
+    if settings.profile != "default":
+        profile["backlog"] = settings.backlog
+    return profile
+
+def run(app, settings: Settings) -> None:
+    """
+    Starts the server with the configured runtime profile.
+
+    Args:
+        app (FastAPI) - application instance, used when running a single process
+        settings (Settings) - app configuration
+    """
+    profile = get_profile(settings)
+    workers = settings.workers if settings.profile != "default" else 1
+    check_workers(settings, workers)
+
+    if workers <= 1:
+        uvicorn.run(app, **profile)
+    elif settings.reuse_port and hasattr(socket, "SO_REUSEPORT"):
+        print(f"Starting {workers} workers with SO_REUSEPORT")
+        _run_reuse_port_workers(profile, workers)
+    else:
+        uvicorn.run(APP, workers=workers, **profile)
+
+def check_workers(settings: Settings, workers: int) -> None:
+    """
+    Raises ValueError if the configuration does not work with several workers
+    (see the note on workers above)
+    """
+    if workers <= 1:
+        return
+
+    stateful_routers = [name for name in settings.routers if name not in STATELESS_ROUTERS]
+    if stateful_routers:
+        raise ValueError(f"WS_WORKERS={workers} can not be used with the routers {stateful_routers}, "
+                         f"their state is kept in the memory of a single process. "
+                         f"Use WS_WORKERS=1, or only enable {sorted(STATELESS_ROUTERS)}")
+
+    shared_paths = [name for name, value in (("WS_STATE_DIR", settings.state_dir),
+                                             ("WS_DRAIN_FILE", settings.drain_file),
+                                             ("WS_TRANSCRIPT_DIR", settings.transcript_dir)) if value]
+    if shared_paths:
+        raise ValueError(f"WS_WORKERS={workers} can not be used with {shared_paths}, "
+                         f"the workers would write to the same files. Use WS_WORKERS=1")
+
+def _run_reuse_port_workers(profile: dict, workers: int) -> None:
+    """
+    Starts the workers, each one listening on its own socket bound to the same
+    port. Waits for all of them to exit.
+    """
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=_serve_reuse_port, args=(profile,)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    def stop_workers(signum, frame):
+        # uvicorn shuts down gracefully on SIGTERM
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGINT, stop_workers)
+    signal.signal(signal.SIGTERM, stop_workers)
+    for process in processes:
+        process.join()
+
+def _serve_reuse_port(profile: dict) -> None:
+    """
+    Worker process entrypoint
+    """
+    sock = socket.socket(socket.AF_INET6 if ":" in profile["host"] else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((profile["host"], profile["port"]))
+    sock.listen(profile.get("backlog", 2048))
+    sock.set_inheritable(True)
+
+    server = uvicorn.Server(uvicorn.Config(APP, **profile))
+    try:
+        server.run(sockets=[sock])
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,118 @@
+"""
+Multi-tenant routing.
+
+When WS_TENANT_TOKENS is configured, the token (`token` query parameter or
+`Authorization: Bearer` header) decides which tenants a connection may use.
+The path (e.g. /hh/{tenant_id}/user) or the `tenant_id` query parameter
+(agents: `tenant_ids`, comma separated) can only narrow that list down.
+Connections without a known token, or asking for a tenant outside of the list
+of their token, are rejected (close code 1008, policy violation).
+
+Without tokens (local development), the tenant is taken from the path, then
+the query parameter, and WS_DEFAULT_TENANT is used if neither is given.
+
+Agents can serve several tenants. Which tenant queue an agent picks the next
+user from is decided by weighted fair queuing, so a tenant with a long queue
+can not starve the others (no cross-tenant head-of-line blocking):
+
+Every tenant has a weight w (WS_TENANT_WEIGHTS, default 1) and a virtual finish
+time, which moves by 1 / w every time the tenant is served. The next pickup of
+a tenant starts at its finish time, but no earlier than the current virtual
+time (start time of the last pickup), so tenants that were idle do not build
+up credit. The agent picks the tenant with the smallest start time among its
+tenants that have someone waiting (start-time fair queuing). Over time tenant i
+gets w_i / sum(w) of the pickups of the agents it shares.
+"""
+from fastapi import WebSocket
+from typing import Dict, Iterable, List, Optional
+
+from config import settings
+
+POLICY_VIOLATION = 1008 # Websocket close code
+
+
+def _get_token(websocket: WebSocket) -> Optional[str]:
+    token = websocket.query_params.get("token")
+    if token:
+        return token
+    authorization = websocket.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        return authorization[len("bearer "):].strip()
+    return None
+
+def _get_requested_tenant_ids(websocket: WebSocket) -> List[str]:
+    """
+    Tenants asked for in the path or the query
+    """
+    tenant_id = websocket.path_params.get("tenant_id")
+    if tenant_id:
+        return [tenant_id]
+
+    tenant_ids = websocket.query_params.get("tenant_ids") or websocket.query_params.get("tenant_id") or ""
+    return [tenant_id.strip() for tenant_id in tenant_ids.split(",") if tenant_id.strip()]
+
+def resolve_tenant_ids(websocket: WebSocket) -> Optional[List[str]]:
+    """
+    All tenants the connection belongs to (agents may have several).
+    None if the connection is not allowed to use the tenants (see reject).
+    """
+    requested = _get_requested_tenant_ids(websocket)
+    if not settings.tenant_tokens:
+        return requested or [settings.default_tenant]
+
+    token = _get_token(websocket)
+    allowed = settings.tenant_tokens.get(token) if token else None
+    if not allowed:
+        return None
+    if not requested:
+        return list(allowed)
+    if any(tenant_id not in allowed for tenant_id in requested):
+        return None
+    return requested
+
+def resolve_tenant_id(websocket: WebSocket) -> Optional[str]:
+    """
+    Tenant of a user connection. None if it is not allowed.
+    """
+    tenant_ids = resolve_tenant_ids(websocket)
+    return tenant_ids[0] if tenant_ids else None
+
+async def reject(websocket: WebSocket) -> None:
+    """
+    Rejects a connection that is not allowed to use the tenants it asked for.
+    Should be called before the websocket is accepted. It is accepted and
+    closed right away, so the client gets the close code (not an HTTP 403).
+    """
+    await websocket.accept()
+    await websocket.close(code=POLICY_VIOLATION, reason="Tenant not allowed")
+
+
+class TenantScheduler():
+    def __init__(self, weights: Optional[Dict[str, float]] = None) -> None:
+        self.weights = weights if weights is not None else {}
+        self.finish_times: Dict[str, float] = {}
+        self.virtual_time = 0.0
+
+    def order_tenants(self, tenant_ids: Iterable[str], pool) -> List[str]:
+        """
+        Tenants that have users waiting, in the order they should be served.
+        O(k log k), k - number of tenants of the agent (or tenants with waiting
+        users, whichever is smaller).
+        """
+        tenant_ids = set(tenant_ids)
+        if len(tenant_ids) > len(pool.pool):
+            candidates = [tenant_id for tenant_id in pool.pool if tenant_id in tenant_ids]
+        else:
+            candidates = [tenant_id for tenant_id in tenant_ids if tenant_id in pool.pool]
+        return sorted(candidates, key=lambda tenant_id: (self._start_time(tenant_id), tenant_id))
+
+    def served(self, tenant_id: str) -> None:
+        """
+        Should be called when a user of the tenant was picked up
+        """
+        start_time = self._start_time(tenant_id)
+        self.finish_times[tenant_id] = start_time + 1 / self.weights.get(tenant_id, 1.0)
+        self.virtual_time = start_time
+
+    def _start_time(self, tenant_id: str) -> float:
+        return max(self.finish_times.get(tenant_id, 0.0), self.virtual_time)
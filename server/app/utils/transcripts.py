@@ -0,0 +1,194 @@
+"""
+Transcripts of the human handover conversations.
+
+Every message relayed between a user and an agent (or AI) is recorded for
+compliance. The relay path must never wait for the disk, so:
+
+    1. record() appends the message to an in-memory buffer of its session.
+       That is all the relay path pays for.
+    2. A background task swaps the buffers every `flush_interval` seconds and
+       hands them to a worker thread.
+    3. The worker thread appends the batch (grouped by session) to the current
+       segment file as a new gzip member. Segments are rotated when they grow
+       over `segment_bytes` (uncompressed).
+
+Segment files: <transcript dir>/transcript-<timestamp>-<n>.jsonl.gz
+One line per message: {"session": ..., "ts": ..., "sender": ..., "message": ...}
+
+Backpressure: if the writer falls behind, the buffers grow. Their size and the
+age of the oldest buffered message are reported by metrics(). Past
+`max_buffered` messages new messages are dropped (and counted) rather than
+slowing down the conversations.
+
+Write errors (disk full, permissions): the batch is put back into the buffers
+and retried with the next flush, so nothing is lost while the disk recovers
+(new messages are dropped instead once the buffers are full). Failed writes
+are counted in `write_errors`. Messages that could not be written when the
+recorder was stopped are counted in `lost`.
+"""
+import asyncio
+import gzip
+import json
+import os
+import threading
+import time
+
+from typing import Dict, List, Optional
+
+
+class TranscriptRecorder():
+    def __init__(self) -> None:
+        self.directory: Optional[str] = None
+        self.flush_interval = 1.0
+        self.segment_bytes = 64 * 1024 * 1024
+        self.max_buffered = 100_000
+
+        self.buffers: Dict[str, List[dict]] = {} # session_id -> messages
+        self.buffered = 0
+        self.oldest_buffered: Optional[float] = None
+        self.flush_task: Optional[asyncio.Task] = None
+        self.stopping: Optional[asyncio.Event] = None
+
+        self.segment_path: Optional[str] = None
+        self.segment_size = 0
+        self.segment_count = 0
+        self.write_lock = threading.Lock()
+
+        # Metrics
+        self.written = 0
+        self.dropped = 0
+        self.write_errors = 0
+        self.lost = 0
+        self.last_flush_seconds = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.flush_task is not None
+
+    def record(self, session_id: str, sender: str, message: str) -> None:
+        """
+        Adds the message to the transcript of the session. Never blocks.
+        Does nothing if the recorder was not started.
+        """
+        if self.flush_task is None:
+            return
+        if self.buffered >= self.max_buffered:
+            self.dropped += 1
+            return
+
+        now = time.time()
+        self.buffers.setdefault(session_id, []).append({
+            "session": session_id,
+            "ts": now,
+            "sender": sender,
+            "message": message,
+        })
+        self.buffered += 1
+        if self.oldest_buffered is None:
+            self.oldest_buffered = now
+
+    def start(self, directory: str, flush_interval: float = 1.0, segment_bytes: int = 64 * 1024 * 1024,
+              max_buffered: int = 100_000) -> None:
+        """
+        Starts the background flushing. Must be called from the event loop.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.segment_bytes = segment_bytes
+        self.max_buffered = max_buffered
+        self.stopping = asyncio.Event()
+        self.flush_task = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self) -> None:
+        """
+        Stops the background flushing and writes what is left in the buffers.
+        A flush that is in progress is waited for, not cancelled.
+        """
+        if self.flush_task is None:
+            return
+        self.stopping.set()
+        await self.flush_task
+        self.flush_task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            self.lost += self.buffered
+            print(f"Error writing transcripts, {self.buffered} messages lost: {e}")
+
+    async def flush(self) -> None:
+        """
+        Hands the buffered messages over to a worker thread to be written
+        """
+        if not self.buffers:
+            return
+        batch, self.buffers = self.buffers, {}
+        self.buffered = 0
+        self.oldest_buffered = None
+
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(self._write_batch, batch)
+        except Exception:
+            self.write_errors += 1
+            self._restore(batch)
+            raise
+        self.last_flush_seconds = time.perf_counter() - started
+        self.written += sum(len(messages) for messages in batch.values())
+
+    def metrics(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "buffered": self.buffered,
+            "buffered_sessions": len(self.buffers),
+            "oldest_buffered_seconds": time.time() - self.oldest_buffered if self.oldest_buffered else 0.0,
+            "written": self.written,
+            "dropped": self.dropped,
+            "write_errors": self.write_errors,
+            "lost": self.lost,
+            "last_flush_seconds": self.last_flush_seconds,
+            "segments": self.segment_count,
+        }
+
+    async def _flush_periodically(self) -> None:
+        while not self.stopping.is_set():
+            try:
+                await asyncio.wait_for(self.stopping.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error writing transcripts, will retry: {e}")
+
+    def _restore(self, batch: Dict[str, List[dict]]) -> None:
+        """
+        Puts a batch that failed to be written back in front of the messages
+        that were buffered in the meantime
+        """
+        for session_id, messages in batch.items():
+            self.buffers[session_id] = messages + self.buffers.get(session_id, [])
+            self.buffered += len(messages)
+            if self.oldest_buffered is None or messages[0]["ts"] < self.oldest_buffered:
+                self.oldest_buffered = messages[0]["ts"]
+
+    def _write_batch(self, batch: Dict[str, List[dict]]) -> None:
+        """
+        Runs in a worker thread. Writes the batch as one gzip member.
+        """
+        data = "".join(json.dumps(message) + "\n" for messages in batch.values() for message in messages).encode()
+        with self.write_lock:
+            if self.segment_path is None or self.segment_size >= self.segment_bytes:
+                self._rotate()
+            with gzip.open(self.segment_path, "ab") as f:
+                f.write(data)
+            self.segment_size += len(data)
+
+    def _rotate(self) -> None:
+        self.segment_count += 1
+        timestamp = time.strftime("%Y%m%d-%H%M%S")
+        self.segment_path = os.path.join(self.directory, f"transcript-{timestamp}-{self.segment_count}.jsonl.gz")
+        self.segment_size = 0
+
+
+transcript_recorder = TranscriptRecorder()
@@ -0,0 +1,66 @@
+"""
+Measures cold start of the app for different sets of enabled routers.
+
+For every router set we measure, in fresh processes:
+    - import time: how long `import main` takes (builds the app)
+    - ready time: from process start until the first websocket handshake
+
+Usage (from the server folder):
+    python benchmarks/cold_start.py
+    python benchmarks/cold_start.py --runs 10 --router-sets echo echo,hh
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from runtime_profiles import APP_DIR, wait_for_server
+
+IMPORT_SNIPPET = "import time; started = time.perf_counter(); import main; print(time.perf_counter() - started)"
+
+# First websocket endpoint of every router, used to detect that the app is ready
+READY_PATHS = {
+    "echo": "/echo",
+    "broadcast": "/broadcast",
+    "chat": "/chat/none",
+    "hh": "/hh/user",
+}
+
+
+def measure_import(routers: str) -> float:
+    env = dict(os.environ, WS_ROUTERS=routers)
+    output = subprocess.check_output([sys.executable, "-c", IMPORT_SNIPPET], cwd=APP_DIR, env=env,
+                                     stderr=subprocess.DEVNULL)
+    return float(output.strip())
+
+def measure_ready(routers: str, port: int) -> float:
+    env = dict(os.environ, WS_ROUTERS=routers, WS_PORT=str(port), WS_PROFILE="default")
+    uri = f"ws://127.0.0.1:{port}{READY_PATHS[routers.split(',')[0]]}"
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "main.py"], cwd=APP_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        asyncio.run(wait_for_server(uri, timeout=30))
+        return time.perf_counter() - started
+    finally:
+        process.terminate()
+        process.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--router-sets", nargs="+", default=["echo", "hh", "echo,broadcast,chat,hh"])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8091)
+    args = parser.parse_args()
+
+    print(f"{'routers':<24} {'import (ms)':>12} {'ready (ms)':>12}")
+    for routers in args.router_sets:
+        imports = [measure_import(routers) for _ in range(args.runs)]
+        ready = [measure_ready(routers, args.port) for _ in range(args.runs)]
+        print(f"{routers:<24} {statistics.median(imports) * 1000:>12.1f} {statistics.median(ready) * 1000:>12.1f}")
+
+if __name__ == "__main__":
+    main()
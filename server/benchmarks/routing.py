@@ -0,0 +1,212 @@
+"""
+Benchmarks the routing logic of the routers, without network overhead.
+
+Every scenario runs in-process on the simulator (see simulator.py), so the
+numbers only depend on the data structures and the router code:
+    - pool: WaitingPool on its own - add, get_position, remove and pick up
+      (get_next_connection + remove_connection)
+    - handover: users SWITCH to an agent (enqueue), agents pick them up
+      (matchmaking), both sides relay messages, users disconnect
+    - chat: /chat pairs are set up (request + accept) and relay messages
+    - broadcast: connections subscribe to topics and publish to them.
+      Every delivered message counts as an operation.
+
+Ops/sec is measured on the wall clock. Virtual time is how long the scenario
+would take for the clients (e.g. agents waiting for users). Frames are the
+websocket frames the clients received and msgs/frame the messages per frame,
+which goes above 1 with --batch-ms (one transport write per frame).
+
+Note: /chat/none looks for an available user by scanning all users, so the
+chat setup is quadratic. Use a smaller --chat-users for big runs.
+
+Usage (from the server folder):
+    python benchmarks/routing.py
+    python benchmarks/routing.py --users 100000 --chat-users 10000
+    python benchmarks/routing.py --scenarios pool handover --tenants 100 --batch-ms 5
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import time
+
+from simulator import Simulator, run
+from routers.broadcast import manager
+from utils.connection_pool import Connection, WaitingPool
+
+SCENARIOS = ["pool", "handover", "chat", "broadcast"]
+
+
+class Results():
+    def __init__(self) -> None:
+        self.rows = []
+
+    @contextlib.contextmanager
+    def measure(self, scenario: str, operation: str, sim: Simulator = None):
+        """
+        Times the block. The block sets `ops` on the yielded dict.
+        """
+        result = {"ops": 0}
+        virtual_started = sim.now if sim else 0.0
+        frames_started, messages_started = sim.frames() if sim else (0, 0)
+        started = time.perf_counter()
+        yield result
+        wall = time.perf_counter() - started
+        virtual = sim.now - virtual_started if sim else 0.0
+        frames, messages = sim.frames() if sim else (0, 0)
+        self.rows.append((scenario, operation, result["ops"], wall, virtual,
+                          frames - frames_started, messages - messages_started))
+
+    def print(self) -> None:
+        print(f"{'scenario':<10} {'operation':<14} {'ops':>9} {'wall (s)':>9} {'ops/sec':>11} {'virtual (s)':>12}"
+              f" {'frames':>9} {'msgs/frame':>11}")
+        for scenario, operation, ops, wall, virtual, frames, messages in self.rows:
+            ops_per_second = ops / wall if wall > 0 else 0.0
+            messages_per_frame = f"{messages / frames:.2f}" if frames else "-"
+            print(f"{scenario:<10} {operation:<14} {ops:>9} {wall:>9.3f} {ops_per_second:>11.0f} {virtual:>12.3f}"
+                  f" {frames:>9} {messages_per_frame:>11}")
+
+
+async def settle(sim: Simulator, batch_ms: int) -> None:
+    """
+    Lets the endpoints process everything sent so far, including the
+    messages still buffered by the batchers
+    """
+    await sim.settle()
+    if batch_ms:
+        await sim.advance(batch_ms / 1000)
+
+def bench_pool(results: Results, users: int, tenants: int) -> None:
+    pool = WaitingPool()
+    conns = [Connection(f"conn-{i}", f"tenant_{i % tenants}", i) for i in range(users)] # data is set, no reservations
+
+    with results.measure("pool", "add") as result:
+        for conn in conns:
+            pool.add_connection(conn)
+        result["ops"] = users
+
+    with results.measure("pool", "position") as result:
+        for conn in conns:
+            pool.get_position(conn.tenant_id, conn.conn_id)
+        result["ops"] = users
+
+    with results.measure("pool", "remove") as result:
+        for conn in conns[::2]:
+            pool.remove_connection(conn.tenant_id, conn.conn_id)
+        result["ops"] = len(conns[::2])
+
+    with results.measure("pool", "pick up") as result:
+        # What an agent does: take the head of the queue and remove it
+        for tenant in range(tenants):
+            tenant_id = f"tenant_{tenant}"
+            conn = pool.get_next_connection(tenant_id)
+            while conn is not None:
+                pool.remove_connection(tenant_id, conn.conn_id)
+                result["ops"] += 1
+                conn = pool.get_next_connection(tenant_id)
+
+async def bench_handover(sim: Simulator, results: Results, users: int, tenants: int, messages: int,
+                         batch_ms: int) -> None:
+    user_clients = [await sim.connect_user(tenant_id=f"tenant_{i % tenants}", batch_ms=batch_ms)
+                    for i in range(users)]
+
+    with results.measure("handover", "switch", sim) as result:
+        for client in user_clients:
+            await client.send("SWITCH")
+        await settle(sim, batch_ms)
+        result["ops"] = sum(len(tenant_bucket) for tenant_bucket in sim.app.state.connections.pool.values())
+
+    with results.measure("handover", "matchmaking", sim) as result:
+        agent_clients = [await sim.connect_agent(tenant_ids=f"tenant_{i % tenants}", batch_ms=batch_ms)
+                         for i in range(users)]
+        await settle(sim, batch_ms)
+        result["ops"] = sum(1 for client in user_clients if client.websocket.receipient_websocket is not None)
+
+    with results.measure("handover", "relay", sim) as result:
+        # Every client sends a burst of messages, which is what batching is for
+        for client in user_clients + agent_clients:
+            for i in range(messages):
+                await client.send(f"message {i}")
+        await settle(sim, batch_ms)
+        result["ops"] = 2 * users * messages
+
+    with results.measure("handover", "disconnect", sim) as result:
+        for client in user_clients:
+            await client.close()
+        await settle(sim, batch_ms)
+        result["ops"] = users
+
+async def bench_chat(sim: Simulator, results: Results, users: int, messages: int, batch_ms: int) -> None:
+    pairs = []
+    with results.measure("chat", "setup", sim) as result:
+        for _ in range(users // 2):
+            first = await sim.connect_chat("none", batch_ms=batch_ms)
+            await settle(sim, batch_ms)
+            welcome = json.loads(first.received()[0])
+            if isinstance(welcome, list):
+                welcome = json.loads(welcome[0]) # Batched frame
+            user_id = welcome["user_id"]
+            second = await sim.connect_chat(user_id, batch_ms=batch_ms)
+            await first.send(json.dumps({"type": "accept"}))
+            pairs.append((first, second))
+        await settle(sim, batch_ms)
+        result["ops"] = len(pairs)
+
+    with results.measure("chat", "relay", sim) as result:
+        for first, second in pairs:
+            for i in range(messages):
+                await first.send(f"message {i}")
+                await second.send(f"message {i}")
+        await settle(sim, batch_ms)
+        result["ops"] = 2 * len(pairs) * messages
+
+async def bench_broadcast(sim: Simulator, results: Results, users: int, tenants: int, topics: int,
+                          publishes: int, batch_ms: int, seed: int) -> None:
+    clients = [await sim.connect_broadcast(tenant_id=f"tenant_{i % tenants}", batch_ms=batch_ms)
+               for i in range(users)]
+
+    with results.measure("broadcast", "subscribe", sim) as result:
+        for i, client in enumerate(clients):
+            await client.send(json.dumps({"type": "subscribe", "topic": f"topic_{i % topics}"}))
+        await settle(sim, batch_ms)
+        result["ops"] = users
+
+    rng = random.Random(seed)
+    with results.measure("broadcast", "delivery", sim) as result:
+        for i in range(publishes):
+            client = rng.choice(clients)
+            topic = f"topic_{rng.randrange(topics)}"
+            await client.send(json.dumps({"type": "publish", "topic": topic, "content": f"message {i}"}))
+            await settle(sim, batch_ms)
+            result["ops"] += len(manager.get_subscribers(client.websocket.tenant_id, topic))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--users", type=int, default=10_000, help="users (and agents) per scenario")
+    parser.add_argument("--chat-users", type=int, default=2_000)
+    parser.add_argument("--tenants", type=int, default=10)
+    parser.add_argument("--topics", type=int, default=10, help="topics per tenant")
+    parser.add_argument("--messages", type=int, default=5, help="messages per client in a relay burst")
+    parser.add_argument("--publishes", type=int, default=1_000)
+    parser.add_argument("--batch-ms", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    results = Results()
+    # Routers print on every connect and disconnect
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if "pool" in args.scenarios:
+            bench_pool(results, args.users, args.tenants)
+        if "handover" in args.scenarios:
+            run(lambda sim: bench_handover(sim, results, args.users, args.tenants, args.messages, args.batch_ms))
+        if "chat" in args.scenarios:
+            run(lambda sim: bench_chat(sim, results, args.chat_users, args.messages, args.batch_ms))
+        if "broadcast" in args.scenarios:
+            run(lambda sim: bench_broadcast(sim, results, args.users, args.tenants, args.topics, args.publishes,
+                                            args.batch_ms, args.seed))
+    results.print()
+
+if __name__ == "__main__":
+    main()
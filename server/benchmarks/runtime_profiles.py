@@ -0,0 +1,85 @@
+"""
+Compares runtime profiles of the server (see app/utils/runtime.py).
+
+For every profile the server is started as a separate process and we measure:
+    - startup time: from process start until the first /echo handshake succeeds
+    - throughput: echo round-trips per second with several concurrent clients
+
+Usage (from the server folder):
+    python benchmarks/runtime_profiles.py
+    python benchmarks/runtime_profiles.py --clients 50 --messages 2000 --workers 4
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import websockets # type: ignore
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+
+
+async def wait_for_server(uri: str, timeout: float) -> float:
+    """
+    Tries to connect until the server answers. Returns the time it took.
+    """
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        try:
+            async with websockets.connect(uri):
+                return time.perf_counter() - start
+        except OSError:
+            await asyncio.sleep(0.01)
+    raise TimeoutError(f"Server did not start in {timeout} seconds")
+
+async def echo_client(uri: str, messages: int) -> None:
+    async with websockets.connect(uri) as websocket:
+        for i in range(messages):
+            await websocket.send(f"message {i}")
+            await websocket.recv()
+
+async def measure_throughput(uri: str, clients: int, messages: int) -> float:
+    """
+    Returns echo round-trips per second
+    """
+    start = time.perf_counter()
+    await asyncio.gather(*(echo_client(uri, messages) for _ in range(clients)))
+    return clients * messages / (time.perf_counter() - start)
+
+def benchmark_profile(profile: str, args: argparse.Namespace) -> dict:
+    env = dict(os.environ,
+               WS_PROFILE=profile,
+               WS_PORT=str(args.port),
+               WS_WORKERS=str(args.workers),
+               WS_ROUTERS="echo") # Several workers are only allowed for echo
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "main.py"], cwd=APP_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    uri = f"ws://127.0.0.1:{args.port}/echo"
+    try:
+        asyncio.run(wait_for_server(uri, timeout=30))
+        startup = time.perf_counter() - started
+        throughput = asyncio.run(measure_throughput(uri, args.clients, args.messages))
+    finally:
+        process.terminate()
+        process.wait()
+    return {"profile": profile, "startup": startup, "throughput": throughput}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profiles", nargs="+", default=["default", "production"])
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--port", type=int, default=8090)
+    args = parser.parse_args()
+
+    print(f"{'profile':<12} {'startup (s)':>12} {'echo msgs/s':>12}")
+    for profile in args.profiles:
+        result = benchmark_profile(profile, args)
+        print(f"{result['profile']:<12} {result['startup']:>12.3f} {result['throughput']:>12.0f}")
+
+if __name__ == "__main__":
+    main()
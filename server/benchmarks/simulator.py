@@ -0,0 +1,334 @@
+"""
+Deterministic in-process simulator for the websocket routers.
+
+Drives the endpoints of the echo, broadcast, chat and human handover routers
+without uvicorn and without sockets, so the routing logic can be tested and
+benchmarked in isolation:
+
+    - FakeWebSocket is what the endpoint gets instead of starlette's WebSocket.
+      It has the parts of the API the routers use (accept, receive_text,
+      send_text, close, app, query_params, path_params, headers).
+    - SimClient is the other end of the in-memory transport. Messages sent by
+      the client are received by the endpoint and the other way around.
+    - VirtualClockLoop is an event loop with a virtual clock. When nothing is
+      ready to run, the clock jumps to the next timer instead of waiting, so
+      asyncio.sleep (agent search interval, batching windows) takes no time.
+      Callbacks run in the order they were scheduled, so the same scenario
+      always gives the same interleaving and the same virtual time.
+
+Code that reads time.monotonic() directly (queue ETA, drain deadline) still
+sees the wall clock.
+
+Usage:
+    async def scenario(sim: Simulator):
+        user = await sim.connect_user(tenant_id="tenant_1")
+        await user.send("SWITCH")
+        agent = await sim.connect_agent(tenant_ids="tenant_1")
+        await sim.settle()
+        ...
+
+    run(scenario)
+"""
+import asyncio
+import selectors
+import sys
+
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, List, Optional, Tuple
+
+from fastapi import FastAPI, WebSocketDisconnect
+from starlette.datastructures import Headers, QueryParams
+
+from runtime_profiles import APP_DIR
+
+sys.path.insert(0, APP_DIR)
+
+from config import settings # noqa: E402
+from routers import broadcast, chat, echo, human_handover # noqa: E402
+from utils.connection_pool import WaitingPool # noqa: E402
+from utils.drain import drain_manager # noqa: E402
+from utils.tenants import TenantScheduler # noqa: E402
+
+SETTLE_SECONDS = 1e-6 # Virtual time that settle() moves the clock by
+
+
+class VirtualClockSelector(selectors.DefaultSelector):
+    """
+    Selector that moves the virtual clock instead of blocking until a timer
+    is due. Real events (threads waking up the loop) are still delivered.
+    """
+    def __init__(self) -> None:
+        super().__init__()
+        self.now = 0.0
+
+    def select(self, timeout: Optional[float] = None):
+        events = super().select(0)
+        if events or timeout == 0:
+            return events
+        if timeout is None:
+            return super().select(None) # Nothing is scheduled, only threads can wake us up
+        self.now += timeout
+        return []
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    def __init__(self) -> None:
+        super().__init__(VirtualClockSelector())
+
+    def time(self) -> float:
+        return self._selector.now
+
+
+class Channel():
+    """
+    FIFO of messages with a single reader
+    """
+    def __init__(self) -> None:
+        self.items: Deque[Any] = deque()
+        self.waiter: Optional[asyncio.Future] = None
+
+    def put(self, item: Any) -> None:
+        self.items.append(item)
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def get(self) -> Any:
+        while not self.items:
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+        return self.items.popleft()
+
+
+class Disconnect():
+    """
+    Marks the end of the messages of a channel
+    """
+    def __init__(self, code: int = 1000, reason: Optional[str] = None) -> None:
+        self.code = code
+        self.reason = reason
+
+
+class FakeWebSocket():
+    """
+    Server end of the in-memory transport, passed to the endpoints
+    """
+    def __init__(self, app: FastAPI, path_params: Optional[dict] = None, query_params: Optional[dict] = None,
+                 headers: Optional[dict] = None) -> None:
+        self.app = app
+        self.path_params = path_params or {}
+        self.query_params = QueryParams({key: value for key, value in (query_params or {}).items() if value is not None})
+        self.headers = Headers(headers or {})
+
+        self.inbound = Channel() # Client -> endpoint
+        self.client: Optional["SimClient"] = None
+        self.accepted = asyncio.get_running_loop().create_future() # True once accepted, False if rejected
+        self.closed = False
+        self.disconnected = False
+
+    async def accept(self, subprotocol: Optional[str] = None, headers: Optional[list] = None) -> None:
+        if self.accepted.done():
+            raise RuntimeError("WebSocket was already accepted or closed")
+        self.accepted.set_result(True)
+
+    async def receive_text(self) -> str:
+        if self.disconnected:
+            raise RuntimeError('Cannot call "receive" once a disconnect message has been received.')
+        message = await self.inbound.get()
+        if isinstance(message, Disconnect):
+            self.disconnected = True
+            raise WebSocketDisconnect(message.code, message.reason)
+        return message
+
+    async def send_text(self, data: str) -> None:
+        if not self.accepted.done() or self.closed:
+            raise RuntimeError('Cannot call "send" once a close message has been sent.')
+        self.client.deliver(data)
+
+    async def close(self, code: int = 1000, reason: Optional[str] = None) -> None:
+        if self.closed:
+            raise RuntimeError('Unexpected ASGI message "websocket.close", after sending "websocket.close".')
+        self.closed = True
+        if not self.accepted.done():
+            self.accepted.set_result(False) # Rejected during the handshake
+        self.client.server_closed(code, reason)
+        self.inbound.put(Disconnect(code, reason)) # Client acknowledges the close
+
+
+class SimClient():
+    """
+    Client end of the in-memory transport
+    """
+    def __init__(self, websocket: FakeWebSocket) -> None:
+        self.websocket = websocket
+        websocket.client = self
+        self.inbox = Channel()
+        self.task: Optional[asyncio.Task] = None # Endpoint serving the client
+        self.close_code: Optional[int] = None
+
+        # Stats
+        self.frames_received = 0
+        self.frames_dropped = 0 # Sent by the server after the client disconnected
+
+    @property
+    def connected(self) -> bool:
+        return self.close_code is None
+
+    async def send(self, message: str) -> None:
+        if not self.connected:
+            raise RuntimeError("Client is not connected")
+        self.websocket.inbound.put(message)
+
+    async def receive(self) -> str:
+        """
+        Next frame sent by the server. Raises WebSocketDisconnect once the
+        server closed the connection and every frame was read.
+        """
+        message = await self.inbox.get()
+        if isinstance(message, Disconnect):
+            self.inbox.put(message) # Every following receive fails as well
+            raise WebSocketDisconnect(message.code, message.reason)
+        return message
+
+    def received(self) -> List[str]:
+        """
+        Takes all frames received so far, without waiting
+        """
+        messages = [message for message in self.inbox.items if not isinstance(message, Disconnect)]
+        self.inbox.items = deque(message for message in self.inbox.items if isinstance(message, Disconnect))
+        return messages
+
+    async def close(self, code: int = 1000) -> None:
+        if self.connected:
+            self.close_code = code
+            self.websocket.inbound.put(Disconnect(code))
+
+    def deliver(self, message: str) -> None:
+        if not self.connected:
+            self.frames_dropped += 1
+            return
+        self.frames_received += 1
+        self.inbox.put(message)
+
+    def server_closed(self, code: int, reason: Optional[str]) -> None:
+        if self.connected:
+            self.close_code = code
+            self.inbox.put(Disconnect(code, reason))
+
+
+class Simulator():
+    """
+    Connects simulated clients to the router endpoints. The module level
+    state of the routers is reset, so every Simulator starts from scratch.
+
+    Args:
+        pool_factory (Callable) - creates app.state.connections, so other
+            waiting pool implementations can be compared
+    """
+    def __init__(self, pool_factory: Callable[[], Any] = WaitingPool) -> None:
+        self.app = FastAPI()
+        self.app.state.connections = pool_factory()
+        self.app.state.recovered_chat_requests = {}
+        self.clients: List[SimClient] = []
+        self.reset()
+
+    @property
+    def now(self) -> float:
+        """
+        Virtual time in seconds
+        """
+        return asyncio.get_running_loop().time()
+
+    def reset(self) -> None:
+        broadcast.manager.active_connections.clear()
+        broadcast.manager.topics.clear()
+        chat.connected_users.clear()
+        chat.user_chat_states.clear()
+        human_handover.connection_manager.scheduler = TenantScheduler(settings.tenant_weights)
+        drain_manager.connections.clear()
+
+    async def connect_echo(self) -> SimClient:
+        return await self._connect(echo.echo_endpoint)
+
+    async def connect_broadcast(self, tenant_id: Optional[str] = None, batch_ms: int = 0) -> SimClient:
+        return await self._connect(broadcast.broadcast_endpoint, query_params={"tenant_id": tenant_id},
+                                   batch_ms=batch_ms)
+
+    async def connect_chat(self, receiver_id: str = "none", batch_ms: int = 0, resume: Optional[str] = None) -> SimClient:
+        return await self._connect(chat.chat_endpoint, path_params={"receiver_id": receiver_id},
+                                   receiver_id=receiver_id, batch_ms=batch_ms, resume=resume)
+
+    async def connect_user(self, tenant_id: Optional[str] = None, batch_ms: int = 0,
+                           resume: Optional[str] = None) -> SimClient:
+        return await self._connect(human_handover.user_endpoint, query_params={"tenant_id": tenant_id},
+                                   batch_ms=batch_ms, resume=resume)
+
+    async def connect_agent(self, tenant_ids: Optional[str] = None, batch_ms: int = 0) -> SimClient:
+        return await self._connect(human_handover.agent_endpoint, query_params={"tenant_ids": tenant_ids},
+                                   batch_ms=batch_ms)
+
+    def frames(self) -> Tuple[int, int]:
+        """
+        Frames received by the clients so far and the messages in them.
+        A frame sent by a batcher (see utils/batching.py) has several messages.
+        """
+        frames = messages = 0
+        for client in self.clients:
+            frames += client.frames_received
+            messages += client.frames_received
+            batcher = getattr(client.websocket, "batcher", None)
+            if batcher is not None:
+                messages += batcher.messages_sent - batcher.frames_sent
+        return frames, messages
+
+    async def settle(self) -> None:
+        """
+        Runs everything that is ready to run until the endpoints wait for
+        clients or timers again
+        """
+        await asyncio.sleep(SETTLE_SECONDS)
+
+    async def advance(self, seconds: float) -> None:
+        """
+        Moves the virtual clock, running every timer that is due on the way
+        """
+        await asyncio.sleep(seconds)
+
+    async def close(self) -> None:
+        """
+        Disconnects every client and waits for the endpoints to finish
+        """
+        for client in self.clients:
+            await client.close()
+        await asyncio.gather(*(client.task for client in self.clients), return_exceptions=True)
+        self.clients = []
+
+    async def _connect(self, endpoint: Callable[..., Awaitable], path_params: Optional[dict] = None,
+                       query_params: Optional[dict] = None, **kwargs) -> SimClient:
+        """
+        Starts the endpoint with a new client and waits for the handshake.
+        A rejected client is returned already closed.
+        """
+        websocket = FakeWebSocket(self.app, path_params, query_params)
+        client = SimClient(websocket)
+        client.task = asyncio.create_task(endpoint(websocket, **kwargs))
+        self.clients.append(client)
+        await asyncio.wait([websocket.accepted, client.task], return_when=asyncio.FIRST_COMPLETED)
+        return client
+
+
+def run(scenario: Callable[[Simulator], Awaitable[Any]], **kwargs) -> Any:
+    """
+    Runs the scenario on a new Simulator and a virtual clock
+    """
+    async def main():
+        sim = Simulator(**kwargs)
+        try:
+            return await scenario(sim)
+        finally:
+            await sim.close()
+
+    with asyncio.Runner(loop_factory=VirtualClockLoop) as runner:
+        return runner.run(main())